@@ -3,21 +3,27 @@ import os
 # Configure matplotlib for headless/serverless environments BEFORE importing
 os.environ['MPLCONFIGDIR'] = '/tmp/matplotlib'
 os.environ['MPLBACKEND'] = 'Agg'
+os.environ.setdefault('NUMBA_CACHE_DIR', '/tmp/numba_cache')
+# OpenMP en priorité : avec TBB, un noyau parallèle lancé depuis un thread de
+# travail (cas des requêtes ASGI) peut bloquer l'arrêt du processus
+os.environ.setdefault('NUMBA_THREADING_LAYER_PRIORITY', 'omp tbb workqueue')
 
 # Lightweight imports only - heavy libraries are lazy-loaded
 import shutil
-import json
+import sys
 from datetime import datetime
-from typing import List, Dict, Optional, Union, TYPE_CHECKING
-import glob
+from typing import List, Dict, Iterator, Optional, Union, TYPE_CHECKING
 import uuid
 import tempfile
 import zipfile
 import io
 from pathlib import Path
 from collections import Counter
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import re
 import logging
+import orjson
 from pydantic import BaseModel
 
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form, BackgroundTasks, APIRouter
@@ -35,11 +41,18 @@ _pandas = None
 _skimage_transform = None
 _skimage_exposure = None
 _PIL_Image = None
+_cv2 = None
+_image_kernels = None
 _wfdb = None
 _docx = None
 _Document = None
+_lxml_etree = None
 _nltk = None
 _matplotlib_plt = None
+_xlsxwriter = None
+_pyarrow = None
+_process_pool = None
+_http_client = None
 
 def get_pydicom():
     global _pydicom
@@ -90,6 +103,20 @@ def get_PIL_Image():
         _PIL_Image = Image
     return _PIL_Image
 
+def get_cv2():
+    global _cv2
+    if _cv2 is None:
+        import cv2
+        _cv2 = cv2
+    return _cv2
+
+def get_image_kernels():
+    global _image_kernels
+    if _image_kernels is None:
+        from app import image_kernels
+        _image_kernels = image_kernels
+    return _image_kernels
+
 def get_wfdb():
     global _wfdb
     if _wfdb is None:
@@ -106,6 +133,13 @@ def get_docx():
         _Document = Document
     return _docx, _Document
 
+def get_lxml_etree():
+    global _lxml_etree
+    if _lxml_etree is None:
+        from lxml import etree
+        _lxml_etree = etree
+    return _lxml_etree
+
 def get_nltk():
     global _nltk
     if _nltk is None:
@@ -122,6 +156,72 @@ def get_matplotlib_plt():
         _matplotlib_plt = plt
     return _matplotlib_plt
 
+def get_xlsxwriter():
+    global _xlsxwriter
+    if _xlsxwriter is None:
+        import xlsxwriter
+        _xlsxwriter = xlsxwriter
+    return _xlsxwriter
+
+def get_pyarrow():
+    global _pyarrow
+    if _pyarrow is None:
+        import pyarrow
+        import pyarrow.csv
+        _pyarrow = pyarrow
+    return _pyarrow
+
+def _init_process_worker():
+    """
+    Initialise un processus du pool : un seul thread Numba et OpenCV par worker.
+    Le parallélisme vient déjà des cpu_count() processus ; sans cela chacun lancerait
+    cpu_count() threads à son tour (~N² threads sur N cœurs). Exécuté avant toute
+    tâche, donc avant le premier import de Numba dans le worker.
+    """
+    os.environ['NUMBA_NUM_THREADS'] = '1'
+    get_cv2().setNumThreads(1)
+
+def get_process_pool():
+    """Pool de processus partagé pour le traitement CPU des images, démarré au premier usage."""
+    global _process_pool
+    if _process_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # spawn : on ne duplique pas par fork un processus déjà multi-thread (asyncio, Numba, OpenCV)
+        _process_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_process_worker
+        )
+    return _process_pool
+
+def shutdown_process_pool():
+    """Arrête le pool de processus s'il a été démarré."""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+def get_http_client():
+    """Client HTTP asynchrone partagé (pool de connexions keep-alive), créé au premier usage."""
+    global _http_client
+    if _http_client is None:
+        import httpx
+        # Délai très long : le traitement DICOM peut prendre 10+ min par fichier
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(3600.0),  # 60 minutes
+            limits=httpx.Limits(max_keepalive_connections=20),
+            follow_redirects=True
+        )
+    return _http_client
+
+async def close_http_client():
+    """Ferme le client HTTP partagé s'il a été créé."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
 # Configuration constants
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB per file
 MAX_FILES = 50  # Maximum number of files per request
@@ -160,18 +260,19 @@ async def validate_file_upload(files: List[UploadFile], max_files: int = MAX_FIL
                 detail=f"Nom de fichier invalide : '{file.filename}'"
             )
         
-        # Check file size by reading content
-        content = await file.read()
+        # Check file size from the end offset of the spooled file, without reading it
+        file.file.seek(0, os.SEEK_END)
+        size = file.file.tell()
         await file.seek(0)  # Reset file pointer
 
-        if len(content) > max_size:
+        if size > max_size:
             raise HTTPException(
                 status_code=400,
                 detail=f"Fichier '{file.filename}' trop volumineux. Taille maximale : {max_size / (1024*1024):.1f}MB"
             )
         
         # Check for empty files
-        if len(content) == 0:
+        if size == 0:
             raise HTTPException(
                 status_code=400,
                 detail=f"Fichier '{file.filename}' est vide."
@@ -194,9 +295,14 @@ def get_stopwords():
     if _stopwords_cache is None:
         nltk = get_nltk()
         try:
-            nltk.download('stopwords', quiet=True)
             from nltk.corpus import stopwords
-            _stopwords_cache = set(stopwords.words('french'))
+            try:
+                words = stopwords.words('french')
+            except LookupError:
+                # Corpus not installed yet: download it once, then read it again
+                nltk.download('stopwords', quiet=True)
+                words = stopwords.words('french')
+            _stopwords_cache = set(words)
         except:
             _stopwords_cache = set()
     return _stopwords_cache
@@ -206,27 +312,28 @@ from fastapi import FastAPI, UploadFile, File, HTTPException, APIRouter
 from fastapi.responses import StreamingResponse
 import io
 
+# Tags DICOM identifiants supprimés lors de l'anonymisation (forme entière 0xGGGGEEEE,
+# clé native du dictionnaire d'éléments pydicom)
+_TAGS_TO_REMOVE = frozenset([
+    0x00100010, 0x00100020, 0x00100030, 0x00100040,
+    0x00101000, 0x00101001, 0x00102160, 0x00080020,
+    0x00080030, 0x00080090, 0x00081050, 0x00081080
+])
+
 def anonymize_dicom(dicom_data):
-    """Anonymise les données sensibles du fichier DICOM."""
-    tags_to_remove = [
-        (0x0010, 0x0010), (0x0010, 0x0020), (0x0010, 0x0030), (0x0010, 0x0040),
-        (0x0010, 0x1000), (0x0010, 0x1001), (0x0010, 0x2160), (0x0008, 0x0020),
-        (0x0008, 0x0030), (0x0008, 0x0090), (0x0008, 0x1050), (0x0008, 0x1080)
-    ]
-    anonymized_dicom = dicom_data.copy()
-    for tag in tags_to_remove:
-        if tag in anonymized_dicom:
-            del anonymized_dicom[tag]
-    anonymized_dicom.InstitutionName = "Anonymized Healthcare Facility"
-    return anonymized_dicom
+    """Anonymise en place les données sensibles du fichier DICOM et le renvoie."""
+    for tag in _TAGS_TO_REMOVE:
+        dicom_data.pop(tag, None)
+    dicom_data.InstitutionName = "Anonymized Healthcare Facility"
+    return dicom_data
 
 def convert_dicom_to_nifti(dicom_data, patient_id: str, study_id: str, series_id: str):
     """Convertit un fichier DICOM en format NIfTI et extrait les métadonnées, y compris un .hdr."""
-    nib = get_nibabel()
     np = get_numpy()
     try:
         pixel_array = dicom_data.pixel_array
-        nifti_img = nib.Nifti1Image(pixel_array, np.eye(4))
+        # Seule la matrice affine est utile : l'image NIfTI est construite après prétraitement
+        affine = np.eye(4)
 
         # Métadonnées principales
         metadata = {
@@ -250,59 +357,65 @@ def convert_dicom_to_nifti(dicom_data, patient_id: str, study_id: str, series_id
                     pass
 
         # Génération du contenu .hdr (ici en JSON pour la lisibilité)
-        hdr_content = json.dumps(dicom_metadata, indent=2, ensure_ascii=False)
+        hdr_content = orjson.dumps(dicom_metadata, option=orjson.OPT_INDENT_2).decode('utf-8')
 
         return {
             'metadata': metadata,
-            'nifti_img': nifti_img,
+            'affine': affine,
             'pixel_array': pixel_array,
             'hdr_content': hdr_content  # À sauvegarder comme .hdr si besoin
         }
     except Exception as e:
-        print(f"Erreur lors de la conversion en NIfTI : {e}")
-        logger.error(f"Erreur lors de la conversion en NIfTI : {e}")
+        logger.error(f"Erreur lors de la conversion en NIfTI : {e}", exc_info=True)
         return None
 
 def resize_image(image_array, target_size=(256, 256)):
     
-    """Redimensionne l'image à la taille cible."""
+    """Redimensionne l'image à la taille cible (hauteur, largeur)."""
     np = get_numpy()
-    Image = get_PIL_Image()
+    cv2 = get_cv2()
+    height, width = target_size
+    # Déjà à la bonne taille : aucun rééchantillonnage
+    if image_array.shape[-2:] == (height, width):
+        return image_array.astype(np.float32, copy=False)
     if len(image_array.shape) > 2:
-        resized_slices = []
+        # Une coupe à la fois, écrite directement dans le volume de sortie
+        resized = np.empty((image_array.shape[0], height, width), dtype=np.float32)
         for i in range(image_array.shape[0]):
-            img = Image.fromarray(image_array[i].astype(np.float32))
-            img = img.resize(target_size, Image.Resampling.LANCZOS)
-            resized_slices.append(np.array(img))
-        return np.stack(resized_slices, axis=0)
-    else:
-        img = Image.fromarray(image_array.astype(np.float32))
-        img = img.resize(target_size, Image.Resampling.LANCZOS)
-        return np.array(img)
-
-def normalize_image(image_array):
-    
-    """Normalise les valeurs de pixel de l'image entre 0 et 1."""
-    np = get_numpy()
-    min_val = np.min(image_array)
-    max_val = np.max(image_array)
-    if max_val - min_val > 0:
-        normalized_image = (image_array - min_val) / (max_val - min_val)
+            cv2.resize(
+                image_array[i].astype(np.float32, copy=False),
+                (width, height),
+                dst=resized[i],
+                interpolation=cv2.INTER_LANCZOS4
+            )
+        return resized
     else:
-        normalized_image = image_array.astype(np.float32)
-    return normalized_image
+        return cv2.resize(
+            image_array.astype(np.float32, copy=False),
+            (width, height),
+            interpolation=cv2.INTER_LANCZOS4
+        )
 
 def apply_histogram_equalization(image_array):
-    """Applique l'égalisation d'histogramme à l'image."""
+    """
+    Applique l'égalisation d'histogramme à l'image (coupe par coupe pour un volume).
+
+    Chaque coupe est quantifiée sur 256 niveaux entre les percentiles 4 et 96
+    de ses pixels finis : les valeurs hors bornes sont écrêtées, pour qu'un
+    pixel aberrant (artefact métallique, texte incrusté) n'écrase pas la
+    dynamique. La coupe est ensuite remappée via une table de correspondance
+    construite sur son histogramme cumulé (noyau Numba, coupes traitées en
+    parallèle). Les pixels non finis (NaN, inf) valent 0 en sortie.
+    L'égalisation étant insensible à un changement d'échelle affine, aucune
+    normalisation préalable n'est nécessaire. Renvoie un float32 dans [0, 1].
+    """
     np = get_numpy()
-    exposure = get_skimage_exposure()
-    if len(image_array.shape) > 2:
-        equalized_slices = []
-        for i in range(image_array.shape[0]):
-            equalized_slices.append(exposure.equalize_hist(image_array[i]))
-        return np.stack(equalized_slices, axis=0)
-    else:
-        return exposure.equalize_hist(image_array)
+    kernels = get_image_kernels()
+    image_array = np.ascontiguousarray(image_array, dtype=np.float32)
+    slices = image_array.reshape((-1,) + image_array.shape[-2:])
+    equalized = np.empty(slices.shape, dtype=np.float32)
+    kernels.equalize_volume(slices, equalized)
+    return equalized.reshape(image_array.shape)
 
 
 # Fonctions de traitement des signaux (adaptées de votre code)
@@ -322,17 +435,20 @@ def stocker_csv(folder_path: str):
     """
     pd = get_pandas()
     wfdb = get_wfdb()
-    all_metadata = []
     
-    # Parcourt tous les fichiers .hea dans le dossier
-    hea_files = glob.glob(os.path.join(folder_path, '*.hea'))
+    # Parcourt tous les fichiers .hea dans le dossier (fichiers cachés exclus, comme avec glob) ;
+    # os.scandir fournit nom et type de chaque entrée sans appel système supplémentaire
+    with os.scandir(folder_path) as entries:
+        signal_names = [
+            entry.name[:-len('.hea')] for entry in entries
+            if entry.name.endswith('.hea') and not entry.name.startswith('.')
+            and entry.is_file(follow_symlinks=False)
+        ]
     
-    if not hea_files:
+    if not signal_names:
         raise HTTPException(status_code=404, detail=f"Aucun fichier .hea trouvé dans le dossier : {folder_path}")
     
-    for file_path in hea_files:
-        signal_name = os.path.basename(file_path).replace('.hea', '')
-        
+    def lire_entete(signal_name: str) -> Dict:
         try:
             record = wfdb.rdheader(os.path.join(folder_path, signal_name))
             
@@ -346,11 +462,15 @@ def stocker_csv(folder_path: str):
                 
                 metadata_dict[key] = value
             
-            all_metadata.append(metadata_dict)
+            return metadata_dict
             
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Erreur lors du traitement du signal '{signal_name}' : {e}")
     
+    # Lectures des en-têtes (E/S bloquantes) en parallèle ; map conserve l'ordre des fichiers
+    with ThreadPoolExecutor(max_workers=min(32, len(signal_names))) as executor:
+        all_metadata = list(executor.map(lire_entete, signal_names))
+    
     return pd.DataFrame(all_metadata)
 
 def plot_signal(signal_path: str) -> io.BytesIO:
@@ -360,12 +480,18 @@ def plot_signal(signal_path: str) -> io.BytesIO:
     try:
         record = wfdb.rdrecord(signal_path)
         
-        # Créer le plot en mémoire
+        # Créer le plot en mémoire, sur l'unique figure créée par wfdb (fermée ensuite)
         buffer = io.BytesIO()
-        plt.figure(figsize=(12, 6))
-        wfdb.plot_wfdb(record=record, title=f"Signal médical : {record.record_name}")
-        plt.savefig(buffer, format='png')
-        plt.close()
+        fig = wfdb.plot_wfdb(
+            record=record,
+            title=f"Signal médical : {record.record_name}",
+            figsize=(12, 6),
+            return_fig=True
+        )
+        try:
+            fig.savefig(buffer, format='png')
+        finally:
+            plt.close(fig)
         buffer.seek(0)
         
         return buffer
@@ -402,12 +528,112 @@ def division_df(folder_path: str) -> tuple:
     return personal_info_df, metadata_df
 
 # Fonctions d'extraction et de traitement
+
+# Expressions régulières compilées une fois au chargement du module
+_RE_PATIENT = re.compile(r'Patient:\s*([^,]+),\s*(\d+)\s*ans', re.IGNORECASE)
+_RE_NOM = re.compile(r'Nom:\s*([^\n]+)', re.IGNORECASE)
+_RE_PRENOM = re.compile(r'Prénom:\s*([^\n]+)', re.IGNORECASE)
+_RE_AGE = re.compile(r'Âge:\s*(\d+)', re.IGNORECASE)
+_RE_DATE = re.compile(r'Date:\s*([^\n]+)', re.IGNORECASE)
+_RE_MOTIF = re.compile(r'Motif de consultation:\s*([^\n]+)', re.IGNORECASE)
+_RE_ANTECEDENTS = re.compile(r'Antécédents médicaux:\s*([^\n]+)', re.IGNORECASE)
+_RE_DIAGNOSTIC = re.compile(r'Diagnostic:\s*([^\n]+)', re.IGNORECASE)
+_RE_TRAITEMENT = re.compile(r'Traitement:\s*([^\n]+)', re.IGNORECASE)
+_RE_DIGITS = re.compile(r'\d+')
+# Mots de 3 lettres ou plus : ni chiffres, ni ponctuation, ni underscore
+_RE_WORD = re.compile(r'[^\W\d_]{3,}')
+# Mots-clés de section, reconnus en un seul passage par ligne ; le lookahead rend
+# les correspondances chevauchantes ('nom' dans 'prénom'), comme des tests « in »
+_RE_SECTION_KEYWORDS = re.compile(
+    r'(?=(prénom|prenom|nom|âge|age|date|motif|consultation|antécédents|diagnostic|traitement))'
+)
+
+# Éléments WordprocessingML lus directement dans word/document.xml
+_W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_W_BODY = _W_NS + 'body'
+_W_P = _W_NS + 'p'
+_W_R = _W_NS + 'r'
+_W_T = _W_NS + 't'
+_W_BR = _W_NS + 'br'
+_W_HYPERLINK = _W_NS + 'hyperlink'
+_W_BR_TYPE = _W_NS + 'type'
+# Équivalents texte des autres éléments d'un run (mêmes règles que python-docx)
+_W_RUN_CHARS = {
+    _W_NS + 'tab': '\t',
+    _W_NS + 'ptab': '\t',
+    _W_NS + 'cr': '\n',
+    _W_NS + 'noBreakHyphen': '-'
+}
+
+def _docx_run_text(run) -> str:
+    """Texte d'un élément w:r"""
+    parts = []
+    for child in run:
+        if child.tag == _W_T:
+            parts.append(child.text or '')
+        elif child.tag == _W_BR:
+            # Seuls les retours à la ligne comptent, pas les sauts de page/colonne
+            if child.get(_W_BR_TYPE, 'textWrapping') == 'textWrapping':
+                parts.append('\n')
+        else:
+            parts.append(_W_RUN_CHARS.get(child.tag, ''))
+    return ''.join(parts)
+
+def _docx_paragraph_text(paragraph) -> str:
+    """Texte d'un élément w:p : ses runs et ceux de ses liens hypertexte"""
+    parts = []
+    for child in paragraph:
+        if child.tag == _W_R:
+            parts.append(_docx_run_text(child))
+        elif child.tag == _W_HYPERLINK:
+            parts.extend(_docx_run_text(run) for run in child if run.tag == _W_R)
+    return ''.join(parts)
+
 def extract_text_from_docx(file_content: bytes) -> List[str]:
-    """Extraction du texte d'un fichier Word depuis les bytes"""
-    python_docx, Document = get_docx()
-    doc = python_docx.Document(io.BytesIO(file_content))
-    return [p.text for p in doc.paragraphs if p.text.strip() != ""]
+    """
+    Extraction du texte d'un fichier Word depuis les bytes.
+    Lecture en flux de word/document.xml : seuls les paragraphes du corps sont
+    extraits (comme doc.paragraphs de python-docx), sans construire le modèle objet.
+    """
+    etree = get_lxml_etree()
+    lines = []
+    with zipfile.ZipFile(io.BytesIO(file_content)) as docx_zip, docx_zip.open('word/document.xml') as document_xml:
+        for _, paragraph in etree.iterparse(document_xml, events=('end',), tag=_W_P):
+            parent = paragraph.getparent()
+            if parent is None or parent.tag != _W_BODY:
+                continue
+            text = _docx_paragraph_text(paragraph)
+            if text.strip() != "":
+                lines.append(text)
+            # Libérer les éléments déjà traités du corps
+            paragraph.clear()
+            while paragraph.getprevious() is not None:
+                del parent[0]
+    return lines
 
+# Liste étendue de stopwords médicaux
+_MEDICAL_STOPWORDS = frozenset({
+    'patient', 'docteur', 'médecin', 'consultation', 'examen',
+    'antecedent', 'antecedents', 'histoire', 'cas',
+    'motif', 'depuis', 'jours', 'jour', 'mois', 'annee', 'années',
+    'presente', 'presentant', 'sans', 'avec', 'pendant', 'apres', 'avant', 
+    'traitement', 'douleur', 'douleurs'
+})
+
+# Union stopwords français + médicaux, construite une seule fois
+_clean_text_stopwords = None
+
+def get_clean_text_stopwords():
+    global _clean_text_stopwords
+    if _clean_text_stopwords is None:
+        try:
+            _clean_text_stopwords = frozenset(get_stopwords()) | _MEDICAL_STOPWORDS
+        except:
+            _clean_text_stopwords = _MEDICAL_STOPWORDS
+    return _clean_text_stopwords
+
+# Les valeurs de champs se répètent d'un rapport à l'autre (« aucun », diagnostics courants)
+@lru_cache(maxsize=8192)
 def clean_text(text: str) -> str:
     """
     Nettoie le texte en:
@@ -416,41 +642,34 @@ def clean_text(text: str) -> str:
     3. Supprimant les stopwords français et médicaux
     4. Supprimant les mots trop courts (<3 caractères)
     """
-    # Liste étendue de stopwords médicaux
-    medical_stopwords = {
-        'patient', 'docteur', 'médecin', 'consultation', 'examen',
-        'antecedent', 'antecedents', 'histoire', 'cas',
-        'motif', 'depuis', 'jours', 'jour', 'mois', 'annee', 'années',
-        'presente', 'presentant', 'sans', 'avec', 'pendant', 'apres', 'avant', 
-        'traitement', 'douleur', 'douleurs'
-    }
-    
-    # Conversion en minuscules
-    text = text.lower()
-    
-    # Suppression des chiffres et ponctuation spécifique
-    text = re.sub(r'\d+', '', text)
-    text = re.sub(r'[^\w\s]|_', ' ', text)
-    
     # Suppression des stopwords (français + médicaux)
-    try:
-        stop_words = get_stopwords().union(medical_stopwords)
-    except:
-        stop_words = medical_stopwords
-    
-    words = text.split()
-    # Filtrage des mots trop courts et stopwords
-    words = [word for word in words if word not in stop_words and len(word) > 2]
+    stop_words = get_clean_text_stopwords()
     
-    return " ".join(words)
+    # Minuscules, puis tokenisation et filtrage des mots courts en un seul passage
+    return ' '.join(word for word in _RE_WORD.findall(text.lower()) if word not in stop_words)
 
-def parse_report1(lines: List[str]) -> Dict:
+def _index_keyword_lines(lines: List[str]) -> Dict[str, List[int]]:
+    """Indexe en un seul parcours les lignes « clé: valeur » par mot-clé de section contenu"""
+    index = {}
+    for i, line in enumerate(lines):
+        if ':' in line:
+            for keyword in set(_RE_SECTION_KEYWORDS.findall(line.lower())):
+                index.setdefault(keyword, []).append(i)
+    return index
+
+def _first_keyword_line(lines: List[str], index: Dict[str, List[int]], *keywords: str) -> Optional[str]:
+    """Renvoie la première ligne indexée contenant l'un des mots-clés, ou None"""
+    positions = [index[keyword][0] for keyword in keywords if keyword in index]
+    return lines[min(positions)] if positions else None
+
+def parse_report1(lines: List[str], lines_as_string: Optional[str] = None) -> Dict:
     """Analyse les lignes de texte pour repérer les champs importants (format 1)"""
     report = {}
-    lines_as_string = '\n'.join(lines)
+    if lines_as_string is None:
+        lines_as_string = '\n'.join(lines)
     
     # Extraction des informations du patient
-    patient_match = re.search(r'Patient:\s*([^,]+),\s*(\d+)\s*ans', lines_as_string, re.IGNORECASE)
+    patient_match = _RE_PATIENT.search(lines_as_string)
     if patient_match:
         full_name = patient_match.group(1).split()
         if len(full_name) > 1:
@@ -461,181 +680,216 @@ def parse_report1(lines: List[str]) -> Dict:
         report["Age"] = int(patient_match.group(2))
     
     # Extraction de la date
-    date_match = re.search(r'Date:\s*(.+)', lines_as_string, re.IGNORECASE)
+    date_match = _RE_DATE.search(lines_as_string)
     if date_match:
         report["Date"] = date_match.group(1).strip()
     
     # Extraction des autres champs
     for line in lines:
-        lower_line = line.lower()
-        if "motif" in lower_line and "consultation" in lower_line and ":" in line:
+        if ":" not in line:
+            continue
+        keywords = set(_RE_SECTION_KEYWORDS.findall(line.lower()))
+        if "motif" in keywords and "consultation" in keywords:
             report["Symptômes"] = clean_text(line.split(":", 1)[1])
-        elif "antécédents" in lower_line and ":" in line:
+        elif "antécédents" in keywords:
             report["Antécédents"] = clean_text(line.split(":", 1)[1])
-        elif "diagnostic" in lower_line and ":" in line:
+        elif "diagnostic" in keywords:
             report["Diagnostic"] = clean_text(line.split(":", 1)[1])
-        elif "traitement" in lower_line and ":" in line:
+        elif "traitement" in keywords:
             report["Traitement"] = clean_text(line.split(":", 1)[1])
     
     return report
 
-def parse_report2(lines: List[str]) -> Dict:
+# Libellés exacts (en minuscules) des lignes « clé: valeur » du format 2
+_REPORT2_FIELD_MAP = {
+    'nom': 'Nom',
+    'prénom': 'Prénom',
+    'âge': 'Age',
+    'date': 'Date',
+    'motif de consultation': 'Symptômes',
+    'antécédents médicaux': 'Antécédents',
+    'diagnostic': 'Diagnostic',
+    'traitement': 'Traitement'
+}
+_REPORT2_FIELDS = ('Nom', 'Prénom', 'Age', 'Date', 'Symptômes', 'Antécédents', 'Diagnostic', 'Traitement')
+_CLEANED_FIELDS = frozenset({'Symptômes', 'Antécédents', 'Diagnostic', 'Traitement'})
+
+def parse_report2(lines: List[str], lines_as_string: Optional[str] = None) -> Dict:
     """Fonction alternative pour extraire les informations (format 2)"""
     report = {}
-    lines_as_string = '\n'.join(lines)
+    # Passage unique : lignes « clé: valeur » dont la clé est exactement un libellé connu
+    for line in lines:
+        colon = line.find(':')
+        if colon < 0:
+            continue
+        field = _REPORT2_FIELD_MAP.get(line[:colon].strip().lower())
+        value = line[colon + 1:].strip()
+        if field is None or field in report or not value:
+            continue
+        if field == "Age":
+            age_num = _RE_DIGITS.match(value)
+            if age_num:
+                report["Age"] = int(age_num.group())
+        elif field in _CLEANED_FIELDS:
+            report[field] = clean_text(value)
+        else:
+            report[field] = value
+    
+    if len(report) == len(_REPORT2_FIELDS):
+        return {field: report[field] for field in _REPORT2_FIELDS}
+    
+    # Champs manquants : recherche par regex puis par mot-clé, comme auparavant
+    if lines_as_string is None:
+        lines_as_string = '\n'.join(lines)
+    # Lignes de repli par mot-clé, indexées une seule fois pour tous les champs
+    keyword_lines = _index_keyword_lines(lines)
     
     # Extraction du nom
-    nom_match = re.search(r'Nom:\s*([^\n]+)', lines_as_string, re.IGNORECASE)
-    if nom_match:
-        report["Nom"] = nom_match.group(1).strip()
-    else:
-        for line in lines:
-            if 'nom' in line.lower() and ':' in line:
+    if "Nom" not in report:
+        nom_match = _RE_NOM.search(lines_as_string)
+        if nom_match:
+            report["Nom"] = nom_match.group(1).strip()
+        else:
+            line = _first_keyword_line(lines, keyword_lines, 'nom')
+            if line is not None:
                 report["Nom"] = line.split(':', 1)[1].strip()
-                break
     
     # Extraction du prénom
-    prenom_match = re.search(r'Prénom:\s*([^\n]+)', lines_as_string, re.IGNORECASE)
-    if prenom_match:
-        report["Prénom"] = prenom_match.group(1).strip()
-    else:
-        for line in lines:
-            if 'prénom' in line.lower() and ':' in line:
-                report["Prénom"] = line.split(':', 1)[1].strip()
-                break
-            elif 'prenom' in line.lower() and ':' in line:
+    if "Prénom" not in report:
+        prenom_match = _RE_PRENOM.search(lines_as_string)
+        if prenom_match:
+            report["Prénom"] = prenom_match.group(1).strip()
+        else:
+            line = _first_keyword_line(lines, keyword_lines, 'prénom', 'prenom')
+            if line is not None:
                 report["Prénom"] = line.split(':', 1)[1].strip()
-                break
     
     # Extraction de l'âge
-    age_match = re.search(r'Âge:\s*(\d+)', lines_as_string, re.IGNORECASE)
-    if age_match:
-        report["Age"] = int(age_match.group(1))
-    else:
-        for line in lines:
-            if 'âge' in line.lower() and ':' in line:
-                age_str = line.split(':', 1)[1].strip()
-                age_num = re.search(r'\d+', age_str)
-                if age_num:
-                    report["Age"] = int(age_num.group())
-                    break
-            elif 'age' in line.lower() and ':' in line:
-                age_str = line.split(':', 1)[1].strip()
-                age_num = re.search(r'\d+', age_str)
+    if "Age" not in report:
+        age_match = _RE_AGE.search(lines_as_string)
+        if age_match:
+            report["Age"] = int(age_match.group(1))
+        else:
+            for i in sorted(set(keyword_lines.get('âge', []) + keyword_lines.get('age', []))):
+                age_num = _RE_DIGITS.search(lines[i].split(':', 1)[1])
                 if age_num:
                     report["Age"] = int(age_num.group())
                     break
     
     # Extraction de la date
-    date_match = re.search(r'Date:\s*([^\n]+)', lines_as_string, re.IGNORECASE)
-    if date_match:
-        report["Date"] = date_match.group(1).strip()
-    else:
-        for line in lines:
-            if 'date' in line.lower() and ':' in line:
+    if "Date" not in report:
+        date_match = _RE_DATE.search(lines_as_string)
+        if date_match:
+            report["Date"] = date_match.group(1).strip()
+        else:
+            line = _first_keyword_line(lines, keyword_lines, 'date')
+            if line is not None:
                 report["Date"] = line.split(':', 1)[1].strip()
-                break
     
     # Extraction des autres champs avec regex
-    motif_match = re.search(r'Motif de consultation:\s*([^\n]+)', lines_as_string, re.IGNORECASE)
-    if motif_match:
-        report["Symptômes"] = clean_text(motif_match.group(1))
-    else:
-        for line in lines:
-            if 'motif' in line.lower() and ':' in line:
+    if "Symptômes" not in report:
+        motif_match = _RE_MOTIF.search(lines_as_string)
+        if motif_match:
+            report["Symptômes"] = clean_text(motif_match.group(1))
+        else:
+            line = _first_keyword_line(lines, keyword_lines, 'motif')
+            if line is not None:
                 report["Symptômes"] = clean_text(line.split(':', 1)[1])
-                break
     
     # Antécédents
-    antecedents_match = re.search(r'Antécédents médicaux:\s*([^\n]+)', lines_as_string, re.IGNORECASE)
-    if antecedents_match:
-        report["Antécédents"] = clean_text(antecedents_match.group(1))
-    else:
-        for line in lines:
-            if 'antécédents' in line.lower() and ':' in line:
+    if "Antécédents" not in report:
+        antecedents_match = _RE_ANTECEDENTS.search(lines_as_string)
+        if antecedents_match:
+            report["Antécédents"] = clean_text(antecedents_match.group(1))
+        else:
+            line = _first_keyword_line(lines, keyword_lines, 'antécédents')
+            if line is not None:
                 report["Antécédents"] = clean_text(line.split(':', 1)[1])
-                break
     
     # Diagnostic
-    diagnostic_match = re.search(r'Diagnostic:\s*([^\n]+)', lines_as_string, re.IGNORECASE)
-    if diagnostic_match:
-        report["Diagnostic"] = clean_text(diagnostic_match.group(1))
-    else:
-        for line in lines:
-            if 'diagnostic' in line.lower() and ':' in line:
+    if "Diagnostic" not in report:
+        diagnostic_match = _RE_DIAGNOSTIC.search(lines_as_string)
+        if diagnostic_match:
+            report["Diagnostic"] = clean_text(diagnostic_match.group(1))
+        else:
+            line = _first_keyword_line(lines, keyword_lines, 'diagnostic')
+            if line is not None:
                 report["Diagnostic"] = clean_text(line.split(':', 1)[1])
-                break
     
     # Traitement
-    traitement_match = re.search(r'Traitement:\s*([^\n]+)', lines_as_string, re.IGNORECASE)
-    if traitement_match:
-        report["Traitement"] = clean_text(traitement_match.group(1))
-    else:
-        for line in lines:
-            if 'traitement' in line.lower() and ':' in line:
+    if "Traitement" not in report:
+        traitement_match = _RE_TRAITEMENT.search(lines_as_string)
+        if traitement_match:
+            report["Traitement"] = clean_text(traitement_match.group(1))
+        else:
+            line = _first_keyword_line(lines, keyword_lines, 'traitement')
+            if line is not None:
                 report["Traitement"] = clean_text(line.split(':', 1)[1])
-                break
     
-    return report
+    # Ordre des champs indépendant de l'ordre des lignes
+    return {field: report[field] for field in _REPORT2_FIELDS if field in report}
+
+# Nombre de lignes examinées avant de joindre tout le rapport pour détecter le format
+_REPORT_HEAD_LINES = 5
 
 def parse_report(lines: List[str]) -> Dict:
     """Analyse les lignes pour déterminer le format et appelle la fonction appropriée"""
-    lines_as_string = '\n'.join(lines)
-    
-    # Vérifier le format "Patient: Nom, Âge ans"
-    patient_match = re.search(r'Patient:\s*([^,]+),\s*(\d+)\s*ans', lines_as_string, re.IGNORECASE)
-    if patient_match:
+    # Vérifier le format "Patient: Nom, Âge ans", d'abord sur l'en-tête où il figure habituellement
+    if _RE_PATIENT.search('\n'.join(lines[:_REPORT_HEAD_LINES])):
         return parse_report1(lines)
+    
+    # Sinon, recherche sur tout le texte, joint une seule fois et transmis au parseur
+    lines_as_string = '\n'.join(lines)
+    if _RE_PATIENT.search(lines_as_string):
+        return parse_report1(lines, lines_as_string)
     else:
-        return parse_report2(lines)
+        return parse_report2(lines, lines_as_string)
 
-def generate_annotation_id(row) -> int:
-    """Génère un ID d'annotation de 11 chiffres"""
+# Formats de date essayés dans l'ordre ; à défaut, la date du jour
+_ANNOTATION_DATE_FORMATS = ('%d %B %Y', '%Y-%m-%d', '%d/%m/%Y')
+_DIAGNOSTIC_NORMAL_PATTERN = 'aucun|normal|rien à signaler|sans particularité'
+
+def generate_annotation_ids(df):
+    """
+    Génère les ID d'annotation de 11 chiffres (AAMMJJ, sexe, âge sur 3 chiffres, diagnostic)
+    de toutes les lignes en opérations vectorisées. ID 0 si l'âge ne tient pas sur 3 chiffres.
+    """
     pd = get_pandas()
-    date_str = row.get('Date', datetime.now().strftime("%d %B %Y"))
+    now = pd.Timestamp(datetime.now())
     
-    try:
-        try:
-            current_date = datetime.strptime(str(date_str), '%d %B %Y')
-        except ValueError:
-            try:
-                current_date = datetime.strptime(str(date_str), '%Y-%m-%d')
-            except ValueError:
-                try:
-                    current_date = datetime.strptime(str(date_str), '%d/%m/%Y')
-                except ValueError:
-                    current_date = datetime.now()
-    except:
-        current_date = datetime.now()
-    
-    aa = str(current_date.year % 100).zfill(2)
-    mm = str(current_date.month).zfill(2)
-    jj = str(current_date.day).zfill(2)
-    
-    sexe = 1  # Par défaut féminin
-    if 'Sexe' in row and pd.notna(row['Sexe']):
-        sexe_str = str(row['Sexe']).lower()
-        sexe = 0 if any(m in sexe_str for m in ['homme', 'male', 'm', 'h']) else 1
-    
-    age_str = '000'
-    if 'Age' in row and pd.notna(row['Age']):
-        try:
-            age_str = str(int(row['Age'])).zfill(3)
-        except ValueError:
-            age_str = '000'
+    if 'Date' in df.columns:
+        date_strings = df['Date'].astype(str)
+        dates = None
+        for date_format in _ANNOTATION_DATE_FORMATS:
+            parsed = pd.to_datetime(date_strings, format=date_format, errors='coerce')
+            dates = parsed if dates is None else dates.fillna(parsed)
+        dates = dates.fillna(now)
+    else:
+        dates = pd.Series(now, index=df.index)
     
-    diagnostic = 1
-    if 'Diagnostic' in row and pd.notna(row['Diagnostic']):
-        diag_str = str(row['Diagnostic']).lower()
-        if any(n in diag_str for n in ['aucun', 'normal', 'rien à signaler', 'sans particularité']):
-            diagnostic = 0
+    # Par défaut féminin (1) ; 0 dès que la valeur contient 'm' ou 'h' (homme, male, m, h...)
+    sexe = pd.Series(1, index=df.index)
+    if 'Sexe' in df.columns:
+        masculin = df['Sexe'].notna() & df['Sexe'].astype(str).str.lower().str.contains('[mh]')
+        sexe = sexe.mask(masculin, 0)
     
-    annotation_id_str = f"{aa}{mm}{jj}{sexe}{age_str}{diagnostic}"
+    ages = df['Age'].astype('int64') if 'Age' in df.columns else pd.Series(0, index=df.index)
     
-    if len(annotation_id_str) == 11:
-        return int(annotation_id_str)
-    else:
-        return 0
+    diagnostic = pd.Series(1, index=df.index)
+    if 'Diagnostic' in df.columns:
+        normal = df['Diagnostic'].notna() & df['Diagnostic'].astype(str).str.lower().str.contains(_DIAGNOSTIC_NORMAL_PATTERN)
+        diagnostic = diagnostic.mask(normal, 0)
+    
+    # Composantes en int64 : les champs .dt sont en int32 et déborderaient
+    annotation_ids = (
+        (dates.dt.year.astype('int64') % 100) * 10**9
+        + dates.dt.month.astype('int64') * 10**7
+        + dates.dt.day.astype('int64') * 10**5
+        + sexe * 10**4
+        + ages * 10
+        + diagnostic
+    )
+    return annotation_ids.where((ages >= 0) & (ages <= 999), 0)
 
 def Annotation(df) -> tuple:
     """Génère l'ID d'annotation et divise en deux DataFrames"""
@@ -649,9 +903,14 @@ def Annotation(df) -> tuple:
     else:
         df['Age'] = 0
     
-    df['ID d\'annotation'] = df.apply(generate_annotation_id, axis=1)
+    df['ID d\'annotation'] = generate_annotation_ids(df)
     df['Année de naissance'] = datetime.now().year - df['Age']
     
+    return diviser_annotations(df)
+
+def diviser_annotations(df) -> tuple:
+    """Divise un DataFrame annoté en données personnelles (df1) et médicales (df2)"""
+    pd = get_pandas()
     colonnes_df1 = ['Nom', 'Prénom', 'Année de naissance', 'ID d\'annotation']
     # Garder seulement les colonnes qui existent
     colonnes_df1 = [col for col in colonnes_df1 if col in df.columns]
@@ -663,46 +922,173 @@ def Annotation(df) -> tuple:
     
     return df1, df2
 
-def creer_zip_resultats(df_personnel, df_medical) -> bytes:
+# Valeurs lues comme manquantes par défaut par pandas.read_csv, reprises pour le lecteur pyarrow
+_CSV_NA_VALUES = [
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'
+]
+
+def _lire_csv_arrow(pa, content: bytes):
+    """
+    Lit un CSV avec le lecteur C++ multithread de pyarrow, réglé comme pandas (valeurs
+    manquantes, texte des dates/heures conservé tel quel). Lève une exception si le
+    fichier sort de ce cadre (noms de colonnes en double, texte non UTF-8, fichier refusé).
+    """
+    buffer = pa.py_buffer(content)
+    options = dict(null_values=_CSV_NA_VALUES, strings_can_be_null=True, quoted_strings_can_be_null=True)
+    table = pa.csv.read_csv(buffer, convert_options=pa.csv.ConvertOptions(**options))
+    if len(set(table.column_names)) != len(table.column_names):
+        raise ValueError("noms de colonnes en double")
+    if any(pa.types.is_binary(field.type) for field in table.schema):
+        raise ValueError("texte non UTF-8")
+    
+    # Arrow infère les dates/heures ; pandas les laisse en texte : on relit ces colonnes en chaînes
+    temporelles = {field.name: pa.string() for field in table.schema if pa.types.is_temporal(field.type)}
+    if temporelles:
+        table = pa.csv.read_csv(
+            buffer, convert_options=pa.csv.ConvertOptions(column_types=temporelles, **options)
+        )
+    # Colonnes entièrement vides : float64 (NaN) comme pandas, et non objets None
+    # (sans aucune ligne, pandas les laisse en texte)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_null(field.type) and table.num_rows:
+            table = table.set_column(i, field.name, table.column(i).cast(pa.float64()))
+    return table.to_pandas()
+
+def read_csv_bytes(content: bytes):
+    """
+    Lit un CSV téléversé avec pyarrow (_lire_csv_arrow), ou pandas.read_csv si pyarrow est absent.
+    Un fichier refusé par Arrow (noms de colonnes en double, lignes incomplètes...) est lu
+    en texte par pandas, réécrit en CSV régulier puis relu par Arrow : les types de ses
+    colonnes sont ainsi inférés par le même lecteur que ceux des autres fichiers.
+    """
+    pd = get_pandas()
+    try:
+        pa = get_pyarrow()
+    except ImportError:
+        return pd.read_csv(io.BytesIO(content))
+    try:
+        return _lire_csv_arrow(pa, content)
+    except Exception:
+        df = pd.read_csv(io.BytesIO(content), dtype=str)
+        return _lire_csv_arrow(pa, df.to_csv(index=False).encode('utf-8'))
+
+def dataframe_to_xlsx(df, sheet_name: str = 'Sheet1') -> bytes:
     """
-    Crée un fichier ZIP contenant les résultats en différents formats
+    Écrit un DataFrame en XLSX avec xlsxwriter en mode constant_memory.
+    Les lignes sont écrites dans l'ordre et vidées au fur et à mesure ; pandas écrit
+    colonne par colonne, ce qui est incompatible avec ce mode.
     """
+    xlsxwriter = get_xlsxwriter()
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {
+        'constant_memory': True,
+        'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+        'remove_timezone': True,
+    })
+    worksheet = workbook.add_worksheet(sheet_name)
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    worksheet.write_row(0, 0, [str(col) for col in df.columns], header_format)
+    valeurs = df.astype(object).where(df.notna(), None)
+    for row, values in enumerate(valeurs.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row, 0, values)
+    workbook.close()
+    return buffer.getvalue()
+
+def _json_default(value):
+    """Sérialise les valeurs non natives pour orjson (Timestamp, NaT, etc.)"""
     pd = get_pandas()
-    zip_buffer = io.BytesIO()
+    if pd.isna(value):
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+def dataframe_to_json(df) -> bytes:
+    """Sérialise un DataFrame en JSON (liste d'enregistrements, indenté, UTF-8) avec orjson"""
+    return orjson.dumps(
+        df.to_dict('records'),
+        option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+        default=_json_default,
+    )
+
+class ZipStreamWriter(io.RawIOBase):
+    """
+    Sortie en écriture seule pour zipfile.ZipFile : les octets écrits sont accumulés
+    puis récupérés par drain(), ce qui permet de streamer une archive en cours de création.
+    Non « seekable » : zipfile écrit alors des descripteurs de données après chaque membre.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        return len(data)
+
+    def drain(self) -> bytes:
+        """Renvoie et vide les octets écrits depuis le dernier appel"""
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+def _membre_zip_csv(zip_file: zipfile.ZipFile, name: str) -> zipfile.ZipInfo:
+    """
+    Membre compressé (ZIP_DEFLATED) à ouvrir en écriture (zip_file.open(..., 'w')), daté de
+    maintenant comme avec writestr. Le niveau de l'archive ne peut être reporté sur un ZipInfo
+    que depuis Python 3.13 (compress_level) ; avant, zlib applique son niveau par défaut.
+    """
+    zinfo = zipfile.ZipInfo(name, date_time=datetime.now().timetuple()[:6])
+    zinfo.external_attr = 0o600 << 16
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    if sys.version_info >= (3, 13):
+        zinfo.compress_level = zip_file.compresslevel
+    return zinfo
+
+def creer_zip_resultats(df_personnel, df_medical) -> Iterator[bytes]:
+    """
+    Crée un fichier ZIP contenant les résultats en différents formats.
+    Générateur : chaque membre est émis dès qu'il est écrit, pour un envoi en streaming.
+    """
+    zip_stream = ZipStreamWriter()
     
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+    # Tous les membres compressés au niveau 1 : l'archive est écrite dans un flux non positionnable,
+    # où chaque membre est suivi d'un data descriptor, que les lecteurs en flux (bsdtar,
+    # ZipInputStream) n'acceptent pas sur un membre stocké (ZIP_STORED)
+    with zipfile.ZipFile(zip_stream, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zip_file:
+        # CSV écrits directement dans leur membre de l'archive, sans copie intermédiaire
         # Ajouter CSV
         if not df_personnel.empty:
-            csv_personnel = io.StringIO()
-            df_personnel.to_csv(csv_personnel, index=False, encoding='utf-8')
-            zip_file.writestr('donnees_personnelles.csv', csv_personnel.getvalue().encode('utf-8'))
+            with zip_file.open(_membre_zip_csv(zip_file, 'donnees_personnelles.csv'), 'w') as member:
+                df_personnel.to_csv(member, index=False, encoding='utf-8')
+            yield zip_stream.drain()
         
         if not df_medical.empty:
-            csv_medical = io.StringIO()
-            df_medical.to_csv(csv_medical, index=False, encoding='utf-8')
-            zip_file.writestr('donnees_medicales.csv', csv_medical.getvalue().encode('utf-8'))
+            with zip_file.open(_membre_zip_csv(zip_file, 'donnees_medicales.csv'), 'w') as member:
+                df_medical.to_csv(member, index=False, encoding='utf-8')
+            yield zip_stream.drain()
         
         # Ajouter Excel
         if not df_personnel.empty:
-            excel_personnel = io.BytesIO()
-            with pd.ExcelWriter(excel_personnel, engine='openpyxl') as writer:
-                df_personnel.to_excel(writer, index=False, sheet_name='Personnel')
-            zip_file.writestr('donnees_personnelles.xlsx', excel_personnel.getvalue())
+            zip_file.writestr('donnees_personnelles.xlsx', dataframe_to_xlsx(df_personnel, sheet_name='Personnel'))
+            yield zip_stream.drain()
         
         if not df_medical.empty:
-            excel_medical = io.BytesIO()
-            with pd.ExcelWriter(excel_medical, engine='openpyxl') as writer:
-                df_medical.to_excel(writer, index=False, sheet_name='Medical')
-            zip_file.writestr('donnees_medicales.xlsx', excel_medical.getvalue())
+            zip_file.writestr('donnees_medicales.xlsx', dataframe_to_xlsx(df_medical, sheet_name='Medical'))
+            yield zip_stream.drain()
         
         # Ajouter JSON
         if not df_personnel.empty:
-            json_personnel = df_personnel.to_json(orient='records', indent=2, force_ascii=False)
-            zip_file.writestr('donnees_personnelles.json', json_personnel.encode('utf-8'))
+            zip_file.writestr('donnees_personnelles.json', dataframe_to_json(df_personnel))
+            yield zip_stream.drain()
         
         if not df_medical.empty:
-            json_medical = df_medical.to_json(orient='records', indent=2, force_ascii=False)
-            zip_file.writestr('donnees_medicales.json', json_medical.encode('utf-8'))
+            zip_file.writestr('donnees_medicales.json', dataframe_to_json(df_medical))
+            yield zip_stream.drain()
         
         # Ajouter un fichier README
         readme_content = """# Résultats d'analyse de rapports médicaux
@@ -723,6 +1109,7 @@ def creer_zip_resultats(df_personnel, df_medical) -> bytes:
 L'ID d'annotation permet de relier les données personnelles aux données médicales tout en maintenant l'anonymisation.
 """
         zip_file.writestr('README.md', readme_content.encode('utf-8'))
+        yield zip_stream.drain()
     
-    zip_buffer.seek(0)
-    return zip_buffer.getvalue()
+    # Répertoire central, écrit à la fermeture de l'archive
+    yield zip_stream.drain()
@@ -0,0 +1,103 @@
+"""
+Numba kernels for DICOM image preprocessing
+Imported lazily through app.dependencies.get_image_kernels()
+"""
+import numpy as np
+from numba import njit, prange
+
+
+# Quantization bounds: percentiles of the finite pixels, so that a few outliers
+# (metal artifacts, burned-in overlays) do not squeeze the slice into a handful of bins
+CLIP_LOW_PERCENTILE = 4.0
+CLIP_HIGH_PERCENTILE = 96.0
+# Above this many pixels per slice, percentiles are estimated on every 4th pixel along each axis
+SAMPLE_THRESHOLD = 128 * 128
+SAMPLE_STEP = 4
+
+
+@njit(parallel=True, cache=True)
+def equalize_volume(volume, out):
+    """
+    Histogram-equalize each slice of a (n, H, W) float32 volume into out.
+
+    Each slice is quantized to 256 bins between the 4th and 96th percentiles
+    of its finite pixels (values outside are clipped to the end bins), its
+    cumulative histogram is turned into a lookup table and every pixel is
+    remapped through it. Non-finite pixels (NaN, inf) are left out of the
+    histogram and mapped to 0. Slices are processed in parallel.
+    """
+    n_slices, height, width = volume.shape
+    step = SAMPLE_STEP if height * width > SAMPLE_THRESHOLD else 1
+
+    for i in prange(n_slices):
+        sample = np.empty(((height + step - 1) // step) * ((width + step - 1) // step), dtype=np.float32)
+        n_sample = 0
+        for y in range(0, height, step):
+            for x in range(0, width, step):
+                value = volume[i, y, x]
+                if np.isfinite(value):
+                    sample[n_sample] = value
+                    n_sample += 1
+
+        low = 0.0
+        high = 0.0
+        if n_sample > 0:
+            low, high = _percentile_bounds(sample[:n_sample])
+
+        span = high - low
+        scale = 255.0 / span if span > 0 else 0.0
+
+        hist = np.zeros(256, dtype=np.int64)
+        for y in range(height):
+            for x in range(width):
+                value = volume[i, y, x]
+                if np.isfinite(value):
+                    hist[_bin_index(value, low, scale)] += 1
+
+        lut = np.empty(256, dtype=np.float32)
+        total = 0
+        for b in range(256):
+            total += hist[b]
+            lut[b] = total
+        if total > 0:
+            for b in range(256):
+                lut[b] /= total
+
+        for y in range(height):
+            for x in range(width):
+                value = volume[i, y, x]
+                if np.isfinite(value):
+                    out[i, y, x] = lut[_bin_index(value, low, scale)]
+                else:
+                    out[i, y, x] = 0.0
+
+
+@njit(inline='always')
+def _bin_index(value, low, scale):
+    """Histogram bin of a finite value, clipped to [0, 255] (bounds checking is off)."""
+    index = int((value - low) * scale)
+    if index < 0:
+        return 0
+    if index > 255:
+        return 255
+    return index
+
+
+
+@njit(inline='always')
+def _percentile_bounds(sample):
+    """
+    CLIP_LOW_PERCENTILE and CLIP_HIGH_PERCENTILE of sample, with NumPy's default
+    linear interpolation. A partial sort (np.partition) places only the four
+    order statistics the interpolation needs.
+    """
+    last = sample.size - 1
+    low_pos = last * CLIP_LOW_PERCENTILE / 100.0
+    high_pos = last * CLIP_HIGH_PERCENTILE / 100.0
+    low_index = int(low_pos)
+    high_index = int(high_pos)
+    kth = np.array([low_index, min(low_index + 1, last), high_index, min(high_index + 1, last)])
+    ordered = np.partition(sample, kth)
+    low = ordered[low_index] + (ordered[min(low_index + 1, last)] - ordered[low_index]) * (low_pos - low_index)
+    high = ordered[high_index] + (ordered[min(high_index + 1, last)] - ordered[high_index]) * (high_pos - high_index)
+    return low, high
@@ -4,11 +4,13 @@ Provides real-time status updates for async processing tasks
 """
 import uuid
 import time
+import itertools
 from datetime import datetime
 from enum import Enum
 from typing import Dict, Optional, Any
 from pydantic import BaseModel
 import threading
+from collections import OrderedDict
 
 
 class JobStatus(str, Enum):
@@ -42,24 +44,27 @@ class JobTracker:
     
     def __init__(self, max_jobs: int = 1000):
         self.jobs: Dict[str, JobProgress] = {}
+        # IDs of completed/failed/cancelled jobs, oldest completion first
+        self._finished: "OrderedDict[str, None]" = OrderedDict()
         self.lock = threading.Lock()
         self.max_jobs = max_jobs
     
     def create_job(self, metadata: Optional[Dict[str, Any]] = None) -> str:
         """Create a new job and return its ID"""
         job_id = str(uuid.uuid4())
+        job = JobProgress(
+            job_id=job_id,
+            status=JobStatus.PENDING,
+            created_at=datetime.utcnow().isoformat(),
+            metadata=metadata or {}
+        )
         
         with self.lock:
             # Clean up old jobs if we're at max capacity
             if len(self.jobs) >= self.max_jobs:
                 self._cleanup_old_jobs()
             
-            self.jobs[job_id] = JobProgress(
-                job_id=job_id,
-                status=JobStatus.PENDING,
-                created_at=datetime.utcnow().isoformat(),
-                metadata=metadata or {}
-            )
+            self.jobs[job_id] = job
         
         return job_id
     
@@ -96,6 +101,9 @@ class JobTracker:
             if status in [JobStatus.COMPLETED, JobStatus.FAILED, JobStatus.CANCELLED]:
                 job.completed_at = datetime.utcnow().isoformat()
                 job.progress_percent = 100 if status == JobStatus.COMPLETED else job.progress_percent
+                self._mark_finished(job_id)
+            else:
+                self._finished.pop(job_id, None)
     
     def set_result(self, job_id: str, result: Dict[str, Any]):
         """Set job result"""
@@ -110,39 +118,38 @@ class JobTracker:
                 self.jobs[job_id].error = error
                 self.jobs[job_id].status = JobStatus.FAILED
                 self.jobs[job_id].completed_at = datetime.utcnow().isoformat()
+                self._mark_finished(job_id)
     
     def delete_job(self, job_id: str):
         """Delete a job"""
         with self.lock:
             if job_id in self.jobs:
                 del self.jobs[job_id]
+                self._finished.pop(job_id, None)
     
     def list_jobs(self, status: Optional[JobStatus] = None, limit: int = 100) -> list[JobProgress]:
         """List jobs, optionally filtered by status"""
         with self.lock:
-            jobs = list(self.jobs.values())
+            # Jobs are inserted at creation, so walking the dict backwards is
+            # newest first: no sort, and we stop once `limit` jobs are collected
+            jobs = reversed(self.jobs.values())
             
             if status:
-                jobs = [j for j in jobs if j.status == status]
+                jobs = (j for j in jobs if j.status == status)
             
-            # Sort by created_at descending
-            jobs.sort(key=lambda x: x.created_at, reverse=True)
-            
-            return jobs[:limit]
+            return list(itertools.islice(jobs, limit))
+    
+    def _mark_finished(self, job_id: str):
+        """Record (or refresh) a job's completion, keeping completion order"""
+        self._finished[job_id] = None
+        self._finished.move_to_end(job_id)
     
     def _cleanup_old_jobs(self):
         """Remove oldest completed/failed jobs to free space"""
-        completed_jobs = [
-            (job_id, job) for job_id, job in self.jobs.items()
-            if job.status in [JobStatus.COMPLETED, JobStatus.FAILED, JobStatus.CANCELLED]
-        ]
-        
-        # Sort by completion time
-        completed_jobs.sort(key=lambda x: x[1].completed_at or "")
-        
-        # Remove oldest 10%
-        remove_count = max(1, len(completed_jobs) // 10)
-        for job_id, _ in completed_jobs[:remove_count]:
+        # _finished is already in completion order: pop the oldest 10%, no scan or sort
+        remove_count = max(1, len(self._finished) // 10)
+        for _ in range(min(remove_count, len(self._finished))):
+            job_id, _ = self._finished.popitem(last=False)
             del self.jobs[job_id]
 
 
@@ -1,11 +1,13 @@
 import os
 import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, status, APIRouter, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, RedirectResponse
 from app.routers import images, signaux, text, batch
-from app.middleware import RateLimitMiddleware, RequestLoggingMiddleware, InputSanitizationMiddleware
+from app.middleware import RateLimitMiddleware, RequestLoggingMiddleware, InputSanitizationMiddleware, SelectiveGZipMiddleware, close_rate_limiters
 from app.job_tracker import job_tracker, JobStatus
+from app.dependencies import shutdown_process_pool, close_http_client
 
 # Configure logging
 logging.basicConfig(
@@ -14,17 +16,29 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Stop the image-processing worker processes, if any were started
+    shutdown_process_pool()
+    # Close the pooled HTTP client used by batch processing, if it was created
+    await close_http_client()
+    # Close the rate limiter's Redis connections, if Redis is configured
+    await close_rate_limiters()
+
 app = FastAPI(
     title="API Médicale Unifiée",
     description="API regroupant images, signaux, textes médicaux et traitement par lots",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Custom exception handler to avoid exposing internal details
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logger.error(f"Unhandled exception: {exc}", exc_info=True)
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={
             "detail": "Une erreur interne s'est produite. Veuillez réessayer plus tard.",
@@ -39,12 +53,21 @@ app.add_middleware(InputSanitizationMiddleware)
 # 2. Rate limiting
 rate_limit_calls = int(os.getenv("RATE_LIMIT_CALLS", "100"))
 rate_limit_period = int(os.getenv("RATE_LIMIT_PERIOD", "60"))
-app.add_middleware(RateLimitMiddleware, calls=rate_limit_calls, period=rate_limit_period)
+# Shared across workers through Redis when REDIS_URL is set, in-memory otherwise
+app.add_middleware(
+    RateLimitMiddleware,
+    calls=rate_limit_calls,
+    period=rate_limit_period,
+    redis_url=os.getenv("REDIS_URL")
+)
 
 # 3. Request logging
 app.add_middleware(RequestLoggingMiddleware)
 
-# 4. CORS configuration
+# 4. GZip compression of JSON/text responses (ZIP archives and PNG images are sent as is)
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1024)
+
+# 5. CORS configuration
 allowed_origins = os.getenv("ALLOWED_ORIGINS", "*").split(",")
 app.add_middleware(
     CORSMiddleware,
@@ -144,8 +167,21 @@ api_v1.include_router(batch, prefix="/batch", tags=["Batch Processing"])
 # Mount the versioned API
 app.include_router(api_v1)
 
-# For backward compatibility, also mount routers at root level (can be removed later)
-app.include_router(images, prefix="/images", tags=["Images (Legacy)"])
-app.include_router(signaux, prefix="/signaux", tags=["Signaux (Legacy)"])
-app.include_router(text, prefix="/text", tags=["Text (Legacy)"])
-app.include_router(batch, prefix="/batch", tags=["Batch Processing (Legacy)"])
\ No newline at end of file
+# For backward compatibility, redirect the legacy root-level paths to v1 (can be removed later).
+# Redirecting instead of mounting the routers a second time keeps a single copy of each route.
+LEGACY_PREFIXES = ["images", "signaux", "text", "batch"]
+
+async def redirect_legacy(request: Request):
+    """Permanently redirect a legacy path to its /api/v1 equivalent, keeping method and body"""
+    target = f"/api/v1{request.url.path}"
+    if request.url.query:
+        target = f"{target}?{request.url.query}"
+    return RedirectResponse(target, status_code=status.HTTP_308_PERMANENT_REDIRECT)
+
+for legacy_prefix in LEGACY_PREFIXES:
+    app.add_api_route(
+        f"/{legacy_prefix}/{{legacy_path:path}}",
+        redirect_legacy,
+        methods=["GET", "POST", "PUT", "PATCH", "DELETE"],
+        include_in_schema=False
+    )
\ No newline at end of file
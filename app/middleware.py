@@ -3,51 +3,139 @@ Custom middleware for API rate limiting, request logging, and other cross-cuttin
 """
 import time
 import logging
-from collections import defaultdict
+import random
+import re
+import weakref
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from typing import Dict, Tuple
-from fastapi import Request, HTTPException, status
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import Response, JSONResponse
-import uuid
+from typing import Dict, Optional, Tuple
+from fastapi import HTTPException, status
+from fastapi.responses import ORJSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 logger = logging.getLogger(__name__)
 
+# Health check, root and docs: passed straight through, without logging, sanitization or rate limiting
+FAST_PATHS = frozenset({"/health", "/", "/docs", "/redoc", "/openapi.json"})
 
-class RateLimitMiddleware(BaseHTTPMiddleware):
+
+def _get_header(scope: Scope, name: bytes) -> Optional[str]:
+    """Return the first value of a (lowercase) request header from the ASGI scope"""
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _get_client_host(scope: Scope) -> str:
+    """Return the direct client IP from the ASGI scope"""
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+# Sliding window over a sorted set scored by request time (ms), run atomically in Redis.
+# KEYS[1] = client key, ARGV = now_ms, window_ms, limit, unique member
+# Returns {allowed (0/1), remaining}
+RATE_LIMIT_SCRIPT = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+local count = redis.call('ZCARD', key)
+if count >= limit then
+    return {0, 0}
+end
+redis.call('ZADD', key, now, ARGV[4])
+redis.call('PEXPIRE', key, window)
+return {1, limit - count - 1}
+"""
+
+# Rate limiters built by Starlette (it instantiates middleware itself), so their Redis clients can be closed on shutdown
+_rate_limiters: "weakref.WeakSet[RateLimitMiddleware]" = weakref.WeakSet()
+
+
+async def close_rate_limiters() -> None:
+    """Close the Redis clients of all rate limiters"""
+    for limiter in list(_rate_limiters):
+        await limiter.aclose()
+
+
+class RateLimitMiddleware:
     """
-    Simple in-memory rate limiting middleware.
-    For production, consider using Redis for distributed rate limiting.
+    Sliding-window rate limiting middleware.
+    Uses Redis when a URL is configured so limits are shared across workers,
+    otherwise (or while Redis is unreachable) counts in process memory.
     """
     
-    def __init__(self, app, calls: int = 100, period: int = 60):
+    def __init__(
+        self,
+        app: ASGIApp,
+        calls: int = 100,
+        period: int = 60,
+        redis_url: Optional[str] = None,
+        max_clients: int = 10000,
+        redis_retry_delay: int = 30
+    ):
         """
         Args:
             app: FastAPI application
             calls: Number of calls allowed per period
             period: Time period in seconds
+            redis_url: Redis connection URL (e.g. redis://localhost:6379/0), optional
+            max_clients: Maximum number of clients tracked in memory
+            redis_retry_delay: Seconds to stay on in-memory limits after a Redis failure
         """
-        super().__init__(app)
+        self.app = app
         self.calls = calls
         self.period = period
-        self.clients: Dict[str, list] = defaultdict(list)
+        self.max_clients = max_clients
+        # Constant header value, formatted once rather than on every request
+        self.limit_header = str(calls)
+        # Request timestamps (monotonic, oldest first) per client, least recently seen client first
+        self.clients: "OrderedDict[str, deque]" = OrderedDict()
+        self.redis = None
+        self.redis_script = None
+        self.redis_retry_delay = redis_retry_delay
+        # Monotonic time before which Redis is not tried again, and whether an outage is ongoing
+        self.redis_retry_at = 0.0
+        self.redis_down = False
+        
+        if redis_url:
+            # Optional dependency, only needed for distributed rate limiting
+            import redis.asyncio as redis
+            
+            # Connections are pooled by the client; the script is sent with EVALSHA.
+            # Short timeouts so an unreachable Redis falls back quickly instead of stalling requests
+            self.redis = redis.Redis.from_url(redis_url, socket_connect_timeout=1, socket_timeout=1)
+            self.redis_script = self.redis.register_script(RATE_LIMIT_SCRIPT)
+        
+        _rate_limiters.add(self)
+    
+    async def aclose(self) -> None:
+        """Close the Redis client and its connection pool, if one was created"""
+        if self.redis is not None:
+            await self.redis.aclose()
+            self.redis = None
+            self.redis_script = None
         
-    def _get_client_id(self, request: Request) -> str:
+    def _get_client_id(self, scope: Scope) -> str:
         """Get client identifier from request"""
         # Try to get real IP from headers (for proxy/load balancer scenarios)
-        forwarded = request.headers.get("X-Forwarded-For")
+        forwarded = _get_header(scope, b"x-forwarded-for")
         if forwarded:
             return forwarded.split(",")[0].strip()
         
-        real_ip = request.headers.get("X-Real-IP")
+        real_ip = _get_header(scope, b"x-real-ip")
         if real_ip:
             return real_ip
             
         # Fallback to direct client IP
-        if request.client:
-            return request.client.host
-        return "unknown"
-    
+        return _get_client_host(scope)
+
     def _is_rate_limited(self, client_id: str) -> Tuple[bool, int]:
         """
         Check if client is rate limited.
@@ -55,121 +143,195 @@ class RateLimitMiddleware(BaseHTTPMiddleware):
         Returns:
             (is_limited, remaining_calls)
         """
-        now = time.time()
+        # Monotonic clock: the window is not affected by wall-clock adjustments
+        now = time.monotonic()
         cutoff = now - self.period
         
-        # Clean old entries
-        self.clients[client_id] = [
-            timestamp for timestamp in self.clients[client_id]
-            if timestamp > cutoff
-        ]
+        # Clean old entries, popped from the front since timestamps are in order
+        timestamps = self.clients.pop(client_id, None)
+        if timestamps is None:
+            timestamps = deque()
+        while timestamps and timestamps[0] <= cutoff:
+            timestamps.popleft()
+        
+        # Drop clients with no request left in the window, least recently seen first
+        while self.clients:
+            oldest_id, oldest_timestamps = next(iter(self.clients.items()))
+            if oldest_timestamps and oldest_timestamps[-1] > cutoff:
+                break
+            del self.clients[oldest_id]
+        
+        # Track this client as the most recently seen, within the size cap
+        self.clients[client_id] = timestamps
+        while len(self.clients) > self.max_clients:
+            self.clients.popitem(last=False)
         
         # Check rate limit
-        if len(self.clients[client_id]) >= self.calls:
+        if len(timestamps) >= self.calls:
             return True, 0
         
         # Add current request
-        self.clients[client_id].append(now)
-        remaining = self.calls - len(self.clients[client_id])
+        timestamps.append(now)
+        remaining = self.calls - len(timestamps)
         
         return False, remaining
     
-    async def dispatch(self, request: Request, call_next):
+    async def _check_rate_limit(self, client_id: str) -> Tuple[bool, int]:
+        """
+        Check rate limit in Redis, falling back to memory if Redis fails.
+        
+        Returns:
+            (is_limited, remaining_calls)
+        """
+        if self.redis_script is None:
+            return self._is_rate_limited(client_id)
+        
+        # During an outage, skip Redis (and its connect timeout) until the retry time
+        now = time.monotonic()
+        if now < self.redis_retry_at:
+            return self._is_rate_limited(client_id)
+        if self.redis_down:
+            # A single request probes Redis, concurrent ones keep using memory meanwhile
+            self.redis_retry_at = now + self.redis_retry_delay
+        
+        try:
+            allowed, remaining = await self.redis_script(
+                keys=[f"rl:{client_id}"],
+                args=[int(time.time() * 1000), self.period * 1000, self.calls, f"{random.getrandbits(64):016x}"]
+            )
+        except Exception as e:
+            # Logged once per retry window rather than on every request
+            logger.warning(
+                "Redis rate limiting unavailable, using in-memory limits for %ss: %s",
+                self.redis_retry_delay, e
+            )
+            self.redis_down = True
+            self.redis_retry_at = time.monotonic() + self.redis_retry_delay
+            return self._is_rate_limited(client_id)
+        
+        if self.redis_down:
+            logger.info("Redis rate limiting restored")
+            self.redis_down = False
+            self.redis_retry_at = 0.0
+        
+        return not allowed, int(remaining)
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
         """Process request with rate limiting"""
-        # Skip rate limiting for health check and docs
-        if request.url.path in ["/health", "/docs", "/redoc", "/openapi.json", "/"]:
-            return await call_next(request)
+        # Skip rate limiting for non-HTTP traffic, health check and docs
+        if scope["type"] != "http" or scope["path"] in FAST_PATHS:
+            await self.app(scope, receive, send)
+            return
         
-        client_id = self._get_client_id(request)
-        is_limited, remaining = self._is_rate_limited(client_id)
+        client_id = self._get_client_id(scope)
+        is_limited, remaining = await self._check_rate_limit(client_id)
         
         if is_limited:
-            logger.warning(f"Rate limit exceeded for client: {client_id}")
-            return JSONResponse(
+            logger.warning("Rate limit exceeded for client: %s", client_id)
+            response = ORJSONResponse(
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
                 content={
                     "detail": "Trop de requêtes. Veuillez réessayer plus tard.",
                     "error_type": "rate_limit_exceeded"
                 },
                 headers={
-                    "X-RateLimit-Limit": str(self.calls),
+                    "X-RateLimit-Limit": self.limit_header,
                     "X-RateLimit-Remaining": "0",
                     "X-RateLimit-Reset": str(int(time.time() + self.period))
                 }
             )
+            await response(scope, receive, send)
+            return
         
-        response = await call_next(request)
+        remaining_header = str(remaining)
         
-        # Add rate limit headers
-        response.headers["X-RateLimit-Limit"] = str(self.calls)
-        response.headers["X-RateLimit-Remaining"] = str(remaining)
-        response.headers["X-RateLimit-Reset"] = str(int(time.time() + self.period))
+        async def send_with_headers(message: Message):
+            # Add rate limit headers
+            if message["type"] == "http.response.start":
+                # Appended without scanning for existing values: the routes never set these
+                headers = MutableHeaders(scope=message)
+                headers.append("X-RateLimit-Limit", self.limit_header)
+                headers.append("X-RateLimit-Remaining", remaining_header)
+                headers.append("X-RateLimit-Reset", str(int(time.time() + self.period)))
+            await send(message)
         
-        return response
+        await self.app(scope, receive, send_with_headers)
 
 
-class RequestLoggingMiddleware(BaseHTTPMiddleware):
+class RequestLoggingMiddleware:
     """
     Middleware to log all incoming requests and responses
     """
     
-    async def dispatch(self, request: Request, call_next):
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
         """Log request and response details"""
-        # Generate request ID for tracking
-        request_id = str(uuid.uuid4())
+        if scope["type"] != "http" or scope["path"] in FAST_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
+        # Generate request ID for tracking (64 random bits from the module PRNG, reseeded
+        # after fork, instead of an os.urandom syscall per request for uuid4)
+        request_id = f"{random.getrandbits(64):016x}"
         
         # Get client info
-        client_id = request.client.host if request.client else "unknown"
-        forwarded = request.headers.get("X-Forwarded-For", "")
+        client_id = _get_client_host(scope)
+        forwarded = _get_header(scope, b"x-forwarded-for") or ""
         
         # Start timer
         start_time = time.time()
         
         # Log request
         logger.info(
-            f"Request started | "
-            f"ID: {request_id} | "
-            f"Method: {request.method} | "
-            f"Path: {request.url.path} | "
-            f"Client: {client_id} | "
-            f"Forwarded: {forwarded}"
+            "Request started | "
+            "ID: %s | "
+            "Method: %s | "
+            "Path: %s | "
+            "Client: %s | "
+            "Forwarded: %s",
+            request_id, scope['method'], scope['path'], client_id, forwarded
         )
         
-        # Add request ID to state for use in endpoints if needed
-        request.state.request_id = request_id
+        # Add request ID to state (request.state.request_id) for use in endpoints if needed
+        scope.setdefault("state", {})["request_id"] = request_id
+        
+        async def send_with_request_id(message: Message):
+            if message["type"] == "http.response.start":
+                # Calculate duration
+                duration = time.time() - start_time
+                
+                # Log response
+                logger.info(
+                    "Request completed | "
+                    "ID: %s | "
+                    "Status: %s | "
+                    "Duration: %.3fs",
+                    request_id, message['status'], duration
+                )
+                
+                # Add request ID to response headers
+                MutableHeaders(scope=message)["X-Request-ID"] = request_id
+            await send(message)
         
         try:
-            response = await call_next(request)
-            
-            # Calculate duration
-            duration = time.time() - start_time
-            
-            # Log response
-            logger.info(
-                f"Request completed | "
-                f"ID: {request_id} | "
-                f"Status: {response.status_code} | "
-                f"Duration: {duration:.3f}s"
-            )
-            
-            # Add request ID to response headers
-            response.headers["X-Request-ID"] = request_id
-            
-            return response
+            await self.app(scope, receive, send_with_request_id)
             
         except Exception as e:
             duration = time.time() - start_time
             logger.error(
-                f"Request failed | "
-                f"ID: {request_id} | "
-                f"Error: {str(e)} | "
-                f"Duration: {duration:.3f}s",
+                "Request failed | "
+                "ID: %s | "
+                "Error: %s | "
+                "Duration: %.3fs",
+                request_id, e, duration,
                 exc_info=True
             )
             raise
 
 
-class InputSanitizationMiddleware(BaseHTTPMiddleware):
+class InputSanitizationMiddleware:
     """
     Middleware to sanitize potentially dangerous input patterns
     """
@@ -183,23 +345,73 @@ class InputSanitizationMiddleware(BaseHTTPMiddleware):
         "onload=",  # XSS attempts
     ]
     
-    async def dispatch(self, request: Request, call_next):
+    # All patterns lowercased once and joined into a single alternation, scanned in one pass
+    SUSPICIOUS_RE = re.compile("|".join(re.escape(pattern.lower()) for pattern in SUSPICIOUS_PATTERNS))
+    
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
         """Check request for suspicious patterns"""
+        if scope["type"] != "http" or scope["path"] in FAST_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
         # Check query parameters
-        query_string = str(request.url.query).lower()
-        for pattern in self.SUSPICIOUS_PATTERNS:
-            if pattern.lower() in query_string:
-                logger.warning(
-                    f"Suspicious pattern detected in query: {pattern} | "
-                    f"Path: {request.url.path} | "
-                    f"Client: {request.client.host if request.client else 'unknown'}"
-                )
-                return JSONResponse(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    content={
-                        "detail": "Requête invalide détectée.",
-                        "error_type": "invalid_input"
-                    }
-                )
+        query_string = scope.get("query_string", b"").decode("latin-1").lower()
+        match = self.SUSPICIOUS_RE.search(query_string)
+        if match:
+            logger.warning(
+                "Suspicious pattern detected in query: %s | "
+                "Path: %s | "
+                "Client: %s",
+                match.group(), scope['path'], _get_client_host(scope)
+            )
+            response = ORJSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={
+                    "detail": "Requête invalide détectée.",
+                    "error_type": "invalid_input"
+                }
+            )
+            await response(scope, receive, send)
+            return
+        
+        await self.app(scope, receive, send)
+
+
+class SelectiveGZipMiddleware:
+    """
+    GZip middleware that leaves already-compressed payloads (ZIP archives, PNG plots) untouched.
+    Wraps Starlette's GZipMiddleware: responses with an excluded content type are sent
+    straight to the client, so the compressor never sees them.
+    """
+    
+    # Compressing these again costs CPU on large archives for no size gain
+    EXCLUDED_CONTENT_TYPES = ("application/zip", "image/png")
+    
+    def __init__(self, app: ASGIApp, minimum_size: int = 500, compresslevel: int = 9):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Compress the response unless its content type is excluded"""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        async def app_with_bypass(scope: Scope, receive: Receive, compress_send: Send):
+            bypass = False
+            
+            async def send_selectively(message: Message):
+                nonlocal bypass
+                # The content type is only known once the response starts
+                if message["type"] == "http.response.start":
+                    content_type = Headers(raw=message["headers"]).get("content-type", "")
+                    bypass = content_type.startswith(self.EXCLUDED_CONTENT_TYPES)
+                await (send if bypass else compress_send)(message)
+            
+            await self.app(scope, receive, send_selectively)
         
-        return await call_next(request)
+        await GZipMiddleware(app_with_bypass, self.minimum_size, self.compresslevel)(scope, receive, send)
@@ -3,17 +3,18 @@ Batch Processing Router - Handles ZIP files containing mixed medical data types
 """
 from fastapi import APIRouter, File, UploadFile, HTTPException, BackgroundTasks
 from fastapi.responses import StreamingResponse
+import asyncio
 import os
 import tempfile
 import zipfile
 import shutil
-import io
-import requests
-from pathlib import Path
+from contextlib import ExitStack
 from typing import List, Dict, Tuple
 from datetime import datetime
 import logging
 
+from app.dependencies import get_http_client
+
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
@@ -22,11 +23,33 @@ router = APIRouter()
 IMAGE_EXTENSIONS = {'.dcm', '.dicom'}
 SIGNAL_EXTENSIONS = {'.hea', '.dat', '.qrs', '.edf', '.eeg'}
 TEXT_EXTENSIONS = {'.csv', '.xlsx', '.docx', '.txt', '.json'}
+EXTENSION_CATEGORIES = {
+    **{ext: 'images' for ext in IMAGE_EXTENSIONS},
+    **{ext: 'signals' for ext in SIGNAL_EXTENSIONS},
+    **{ext: 'text' for ext in TEXT_EXTENSIONS},
+}
 
 # Maximum limits for security
 MAX_FILES_IN_ZIP = 1000
 MAX_EXTRACTION_SIZE = 500 * 1024 * 1024  # 500MB
 MAX_COMPRESSION_RATIO = 100  # Protect against ZIP bombs
+EXTRACT_CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# Processing endpoints per category (v1 API endpoints for consistency), on this same API
+CATEGORY_ENDPOINTS = {
+    'images': '/api/v1/images/preprocess_dicom_files/',
+    'signals': '/api/v1/signaux/upload_signals',
+    'text': '/api/v1/text/telecharger_annotations_zip/'
+}
+# Base URL of the API that received the request, read once from the environment
+API_BASE_URL = os.getenv('API_BASE_URL', 'http://localhost:8000')
+
+# Fixed parts of the processing report
+REPORT_HEADER = "\n".join(["=" * 60, "RAPPORT DE TRAITEMENT PAR LOTS", "=" * 60])
+REPORT_FOOTER = "\n".join([f"\n{'=' * 60}", "Traitement terminé.", "=" * 60])
+
+# Final batch ZIP is kept in memory up to this size, then spilled to a temporary file
+FINAL_ZIP_SPOOL_SIZE = 32 * 1024 * 1024  # 32MB
 
 
 def is_safe_path(base_path: str, file_path: str) -> bool:
@@ -35,7 +58,8 @@ def is_safe_path(base_path: str, file_path: str) -> bool:
     """
     abs_base = os.path.abspath(base_path)
     abs_file = os.path.abspath(file_path)
-    return abs_file.startswith(abs_base)
+    # Compare whole path components, so that "/tmp/x/extracted_evil" is not inside "/tmp/x/extracted"
+    return abs_file.startswith(abs_base + os.sep)
 
 
 def extract_zip_safely(zip_file: UploadFile, extract_dir: str) -> Tuple[bool, str, List[str]]:
@@ -46,11 +70,10 @@ def extract_zip_safely(zip_file: UploadFile, extract_dir: str) -> Tuple[bool, st
         (success, error_message, extracted_files)
     """
     try:
-        # Save uploaded ZIP
+        # Save uploaded ZIP, streamed by 1MB chunks instead of loaded whole into memory
         zip_path = os.path.join(extract_dir, "upload.zip")
         with open(zip_path, "wb") as f:
-            content = zip_file.file.read()
-            f.write(content)
+            shutil.copyfileobj(zip_file.file, f, length=1024 * 1024)
 
         # Check if valid ZIP
         if not zipfile.is_zipfile(zip_path):
@@ -83,13 +106,19 @@ def extract_zip_safely(zip_file: UploadFile, extract_dir: str) -> Tuple[bool, st
                 # Prevent path traversal
                 member_path = os.path.join(extract_dir, member.filename)
                 if not is_safe_path(extract_dir, member_path):
-                    logger.warning(f"Skipping potentially malicious path: {member.filename}")
+                    logger.warning("Skipping potentially malicious path: %s", member.filename)
                     continue
 
-                # Extract file
-                zf.extract(member, extract_dir)
+                # Extract file by chunks, counting the bytes actually written rather than
+                # trusting the sizes declared in the ZIP headers
+                os.makedirs(os.path.dirname(member_path), exist_ok=True)
+                with zf.open(member) as source, open(member_path, "wb") as target:
+                    while chunk := source.read(EXTRACT_CHUNK_SIZE):
+                        total_size += len(chunk)
+                        if total_size > MAX_EXTRACTION_SIZE:
+                            return False, f"Le ZIP est trop volumineux (max {MAX_EXTRACTION_SIZE // (1024*1024)}MB)", []
+                        target.write(chunk)
                 extracted_files.append(member_path)
-                total_size += member.file_size
 
         # Remove the uploaded ZIP file
         os.remove(zip_path)
@@ -99,33 +128,15 @@ def extract_zip_safely(zip_file: UploadFile, extract_dir: str) -> Tuple[bool, st
     except zipfile.BadZipFile:
         return False, "Fichier ZIP corrompu", []
     except Exception as e:
-        logger.error(f"Error extracting ZIP: {e}")
+        logger.error("Error extracting ZIP: %s", e)
         return False, f"Erreur lors de l'extraction: {str(e)}", []
 
 
-def group_signal_files(files: List[str]) -> List[List[str]]:
-    """
-    Group signal files by base name (e.g., signal.hea, signal.dat, signal.qrs -> 1 group).
-    A signal is composed of up to 3 files with same base name but different extensions.
-    """
-    signal_groups = {}
-
-    for file_path in files:
-        base_name = Path(file_path).stem
-        ext = Path(file_path).suffix.lower()
-
-        if base_name not in signal_groups:
-            signal_groups[base_name] = []
-
-        signal_groups[base_name].append(file_path)
-
-    # Return as list of groups
-    return list(signal_groups.values())
-
-
 def categorize_files(files: List[str]) -> Dict[str, List]:
     """
     Categorize extracted files by type.
+    Signal files are grouped by base name (e.g., signal.hea, signal.dat, signal.qrs -> 1 group),
+    a signal being composed of up to 3 files with same base name but different extensions.
 
     Returns:
         {
@@ -141,22 +152,20 @@ def categorize_files(files: List[str]) -> Dict[str, List]:
         'text': [],
         'unknown': []
     }
+    signal_groups = {}
 
+    # Single pass with plain string operations: classify, and group signals as they come
     for file_path in files:
-        ext = Path(file_path).suffix.lower()
-
-        if ext in IMAGE_EXTENSIONS:
-            categorized['images'].append(file_path)
-        elif ext in SIGNAL_EXTENSIONS:
-            categorized['signals'].append(file_path)
-        elif ext in TEXT_EXTENSIONS:
-            categorized['text'].append(file_path)
+        ext = os.path.splitext(file_path)[1].lower()
+        category = EXTENSION_CATEGORIES.get(ext, 'unknown')
+
+        if category == 'signals':
+            base_name = os.path.basename(file_path)[:-len(ext)]
+            signal_groups.setdefault(base_name, []).append(file_path)
         else:
-            categorized['unknown'].append(file_path)
+            categorized[category].append(file_path)
 
-    # Group signal files
-    if categorized['signals']:
-        categorized['signals'] = group_signal_files(categorized['signals'])
+    categorized['signals'] = list(signal_groups.values())
 
     return categorized
 
@@ -174,46 +183,35 @@ async def process_file_category(
         (success, zip_bytes, error_message)
     """
     try:
-        # Use v1 API endpoints for consistency
-        endpoint_map = {
-            'images': '/api/v1/images/preprocess_dicom_files/',
-            'signals': '/api/v1/signaux/upload_signals',
-            'text': '/api/v1/text/telecharger_annotations_zip/'
-        }
-
-        endpoint = endpoint_map.get(category)
+        endpoint = CATEGORY_ENDPOINTS.get(category)
         if not endpoint:
-            logger.error(f"Unknown category: {category}")
+            logger.error("Unknown category: %s", category)
             return False, b'', f"Catégorie inconnue: {category}"
 
         url = f"{api_base_url}{endpoint}"
-        logger.info(f"Processing {category} at {url}")
-
-        # Prepare files for upload
-        upload_files = []
+        logger.info("Processing %s at %s", category, url)
 
+        # For signals, files is a list of groups
         if category == 'signals':
-            # For signals, files is a list of groups
-            for group in files:
-                for file_path in group:
-                    filename = os.path.basename(file_path)
-                    with open(file_path, 'rb') as f:
-                        upload_files.append(('files', (filename, f.read(), 'application/octet-stream')))
+            file_paths = [file_path for group in files for file_path in group]
         else:
-            # For images and text
-            for file_path in files:
-                filename = os.path.basename(file_path)
-                with open(file_path, 'rb') as f:
-                    upload_files.append(('files', (filename, f.read(), 'application/octet-stream')))
+            file_paths = files
+
+        with ExitStack() as stack:
+            # Pass open file handles so the multipart body is streamed from disk
+            upload_files = [
+                ('files', (os.path.basename(file_path), stack.enter_context(open(file_path, 'rb')), 'application/octet-stream'))
+                for file_path in file_paths
+            ]
 
-        # Send to processing endpoint
-        # Timeout needs to be VERY long for DICOM processing (can take 10+ min per file)
-        logger.info(f"Sending {len(upload_files)} files to {url}")
-        response = requests.post(url, files=upload_files, timeout=3600)  # 60 minutes
+            # Send to processing endpoint without blocking the event loop,
+            # reusing the shared client's keep-alive connections (60 minutes timeout)
+            logger.info("Sending %d files to %s", len(upload_files), url)
+            response = await get_http_client().post(url, files=upload_files)
 
         if response.status_code != 200:
             error_detail = response.text[:500] if response.text else "No error details"
-            logger.error(f"Error processing {category}: {response.status_code} - {error_detail}")
+            logger.error("Error processing %s: %s - %s", category, response.status_code, error_detail)
             return False, b'', f"Erreur {response.status_code}: {error_detail}"
 
         # Check if response is ZIP
@@ -223,7 +221,7 @@ async def process_file_category(
             return False, b'', f"Réponse inattendue (non-ZIP) pour {category}"
 
     except Exception as e:
-        logger.error(f"Error processing {category}: {e}")
+        logger.error("Error processing %s: %s", category, e)
         return False, b'', str(e)
 
 
@@ -256,10 +254,10 @@ async def process_batch_zip(
         extract_dir = os.path.join(temp_dir, "extracted")
         os.makedirs(extract_dir, exist_ok=True)
 
-        logger.info(f"Processing ZIP: {file.filename}")
+        logger.info("Processing ZIP: %s", file.filename)
 
-        # Extract ZIP safely
-        success, error_msg, extracted_files = extract_zip_safely(file, extract_dir)
+        # Extract ZIP safely (blocking disk I/O, kept off the event loop)
+        success, error_msg, extracted_files = await asyncio.to_thread(extract_zip_safely, file, extract_dir)
 
         if not success:
             raise HTTPException(status_code=400, detail=error_msg)
@@ -267,17 +265,19 @@ async def process_batch_zip(
         if not extracted_files:
             raise HTTPException(status_code=400, detail="Aucun fichier trouvé dans le ZIP")
 
-        logger.info(f"Extracted {len(extracted_files)} files")
+        logger.info("Extracted %d files", len(extracted_files))
 
         # Categorize files
         categorized = categorize_files(extracted_files)
 
         # Log categorization
-        logger.info(f"Categorization: "
-                   f"images={len(categorized['images'])}, "
-                   f"signals={len(categorized['signals'])} groups, "
-                   f"text={len(categorized['text'])}, "
-                   f"unknown={len(categorized['unknown'])}")
+        logger.info("Categorization: "
+                   "images=%d, "
+                   "signals=%d groups, "
+                   "text=%d, "
+                   "unknown=%d",
+                   len(categorized['images']), len(categorized['signals']),
+                   len(categorized['text']), len(categorized['unknown']))
 
         # Check if we have processable files
         processable_count = (len(categorized['images']) +
@@ -290,53 +290,46 @@ async def process_batch_zip(
                 detail=f"Aucun fichier traitable trouvé. Fichiers non reconnus: {len(categorized['unknown'])}"
             )
 
-        # Get API base URL from environment or construct from request
-        # Use the same host/port that received this request
-        api_base_url = os.getenv('API_BASE_URL', 'http://localhost:8000')
-
-        # Process each category
+        # Process each category concurrently (independent calls to different endpoints)
         results = {}
         errors = {}
 
-        for category in ['images', 'signals', 'text']:
-            if category == 'signals':
-                # Check if we have signal groups
-                if not categorized[category]:
-                    continue
-            else:
-                # Check if we have files
-                if not categorized[category]:
-                    continue
+        categories = [category for category in ['images', 'signals', 'text'] if categorized[category]]
+        logger.info("Processing %s...", ', '.join(categories))
 
-            logger.info(f"Processing {category}...")
-            success, zip_content, error = await process_file_category(
-                category,
-                categorized[category],
-                api_base_url,
-                temp_dir
-            )
+        outcomes = await asyncio.gather(
+            *[
+                process_file_category(category, categorized[category], API_BASE_URL, temp_dir)
+                for category in categories
+            ],
+            return_exceptions=True
+        )
+
+        for category, outcome in zip(categories, outcomes):
+            if isinstance(outcome, Exception):
+                outcome = (False, b'', str(outcome))
+            success, zip_content, error = outcome
 
             if success:
                 results[category] = zip_content
-                logger.info(f"{category} processed successfully ({len(zip_content)} bytes)")
+                logger.info("%s processed successfully (%d bytes)", category, len(zip_content))
             else:
                 errors[category] = error
-                logger.error(f"Failed to process {category}: {error}")
+                logger.error("Failed to process %s: %s", category, error)
 
         # Create final ZIP with all results
-        final_zip_buffer = io.BytesIO()
+        # Small results stay in memory, large ones spill to disk
+        final_zip_file = tempfile.SpooledTemporaryFile(max_size=FINAL_ZIP_SPOOL_SIZE)
 
-        with zipfile.ZipFile(final_zip_buffer, 'w', zipfile.ZIP_DEFLATED) as final_zip:
-            # Add processed ZIPs
+        with zipfile.ZipFile(final_zip_file, 'w', zipfile.ZIP_DEFLATED) as final_zip:
+            # Add processed ZIPs, stored as is since they are already compressed
             for category, content in results.items():
                 zip_name = f"{category}_results.zip"
-                final_zip.writestr(zip_name, content)
+                final_zip.writestr(zip_name, content, compress_type=zipfile.ZIP_STORED)
 
             # Create processing report
             report_lines = [
-                "=" * 60,
-                "RAPPORT DE TRAITEMENT PAR LOTS",
-                "=" * 60,
+                REPORT_HEADER,
                 f"\nFichier source: {file.filename}",
                 f"Date de traitement: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
                 f"\nFichiers extraits: {len(extracted_files)}",
@@ -345,7 +338,7 @@ async def process_batch_zip(
                 f"Signaux: {len(categorized['signals'])} groupes",
                 f"Documents texte: {len(categorized['text'])} fichiers",
                 f"Non reconnus: {len(categorized['unknown'])} fichiers",
-                f"\n--- RÉSULTATS ---",
+                "\n--- RÉSULTATS ---",
             ]
 
             for category in ['images', 'signals', 'text']:
@@ -357,20 +350,23 @@ async def process_batch_zip(
                     report_lines.append(f"- {category}: Aucun fichier à traiter")
 
             if categorized['unknown']:
-                report_lines.append(f"\n--- FICHIERS NON RECONNUS ---")
-                for unknown_file in categorized['unknown'][:20]:  # Limit to 20
-                    report_lines.append(f"  - {os.path.basename(unknown_file)}")
+                report_lines.append("\n--- FICHIERS NON RECONNUS ---")
+                report_lines.extend(
+                    f"  - {os.path.basename(unknown_file)}"
+                    for unknown_file in categorized['unknown'][:20]  # Limit to 20
+                )
                 if len(categorized['unknown']) > 20:
                     report_lines.append(f"  ... et {len(categorized['unknown']) - 20} autres")
 
-            report_lines.append(f"\n{'=' * 60}")
-            report_lines.append("Traitement terminé.")
-            report_lines.append("=" * 60)
+            report_lines.append(REPORT_FOOTER)
+
+            final_zip.writestr("processing_report.txt", "\n".join(report_lines).encode('utf-8'))
 
-            report_content = "\n".join(report_lines)
-            final_zip.writestr("processing_report.txt", report_content.encode('utf-8'))
+        final_zip_file.seek(0)
 
-        final_zip_buffer.seek(0)
+        def iter_final_zip():
+            while chunk := final_zip_file.read(1024 * 1024):
+                yield chunk
 
         # Schedule cleanup
         def remove_temp_files():
@@ -378,13 +374,14 @@ async def process_batch_zip(
                 shutil.rmtree(temp_dir, ignore_errors=True)
 
         background_tasks.add_task(remove_temp_files)
+        background_tasks.add_task(final_zip_file.close)
 
         # Return final ZIP
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         filename = f"processed_batch_{timestamp}.zip"
 
         return StreamingResponse(
-            final_zip_buffer,
+            iter_final_zip(),
             media_type="application/zip",
             headers={"Content-Disposition": f"attachment; filename={filename}"}
         )
@@ -392,7 +389,7 @@ async def process_batch_zip(
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Batch processing error: {e}", exc_info=True)
+        logger.error("Batch processing error: %s", e, exc_info=True)
         raise HTTPException(
             status_code=500,
             detail="Erreur lors du traitement du fichier ZIP."
@@ -403,7 +400,7 @@ async def process_batch_zip(
             try:
                 shutil.rmtree(temp_dir)
             except Exception as cleanup_error:
-                logger.error(f"Failed to cleanup temp directory: {cleanup_error}")
+                logger.error("Failed to cleanup temp directory: %s", cleanup_error)
 
 
 @router.get("/")
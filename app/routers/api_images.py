@@ -1,9 +1,12 @@
 import os
+import asyncio
 import shutil
 import json
+import csv
 import base64
 from datetime import datetime
 from typing import List
+from concurrent.futures import as_completed
 import tempfile
 import zipfile
 import io
@@ -16,8 +19,149 @@ from fastapi.responses import StreamingResponse, FileResponse
 
 router = APIRouter()
 
+ZIP_SPOOL_MAX_SIZE = 64 * 1024 * 1024  # Au-delà, l'archive est écrite sur disque
+STREAM_CHUNK_SIZE = 1024 * 1024
+DICOM_DEFER_SIZE = "1 KB"  # Éléments plus volumineux lus seulement à l'accès
+
+
+def _iter_file_chunks(file_obj, chunk_size: int = STREAM_CHUNK_SIZE):
+    """Lit un fichier par blocs pour le streaming de la réponse, puis le ferme."""
+    try:
+        while chunk := file_obj.read(chunk_size):
+            yield chunk
+    finally:
+        file_obj.close()
+
+class DicomProcessingError(Exception):
+    """
+    Échec du traitement d'un fichier DICOM, converti en HTTPException par l'appelant.
+    Contrairement à HTTPException, elle se transmet depuis un processus du pool (picklable).
+    """
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
 # Fonctions de prétraitement du notebook (adaptées pour l'API)
 
+def _process_dicom_file(content: bytes, filename: str, n: int, m: int) -> dict:
+    """
+    Anonymise, convertit en NIfTI et prétraite un fichier DICOM.
+    Renvoie ses sorties sans identifiants : ceux-ci sont attribués ensuite par
+    _number_result, une fois connus les fichiers traités avec succès. Aucun état
+    partagé entre fichiers, ce qui permet de l'exécuter dans un processus du pool
+    (get_process_pool).
+    """
+    try:
+        pydicom = get_pydicom()
+        dicom_data = pydicom.dcmread(io.BytesIO(content), defer_size=DICOM_DEFER_SIZE)
+    except Exception:
+        raise DicomProcessingError(status_code=400, detail=f"Le fichier {filename} n'est pas un fichier DICOM valide.")
+
+    # Extraire les métadonnées originales
+    original = {
+        'original_patient_id': str(dicom_data.get('PatientID', '')),
+        'original_study_id': str(dicom_data.get('StudyID', '')),
+        'original_modality': str(dicom_data.get('Modality', '')),
+        'original_study_date': str(dicom_data.get('StudyDate', '')),
+        'Study_Description': str(dicom_data.get('StudyDescription', '')),
+        'Study_Time': str(dicom_data.get('StudyTime', ''))
+    }
+
+    # Anonymiser les données
+    anonymized_dicom = anonymize_dicom(dicom_data)
+
+    # Convertir en NIfTI et prétraiter (identifiants renseignés par _number_result)
+    conversion_result = convert_dicom_to_nifti(anonymized_dicom, '', '', '')
+
+    if not conversion_result:
+        raise DicomProcessingError(status_code=500, detail=f"Erreur lors de la conversion ou du prétraitement pour le fichier {filename}.")
+
+    image_data = conversion_result['pixel_array']
+    affine = conversion_result['affine']
+
+    # Appliquer le prétraitement
+    try:
+        # Conversion unique en float32 contigu : les étapes suivantes ne recopient plus
+        np = get_numpy()
+        image_data = np.ascontiguousarray(image_data, dtype=np.float32)
+        resized_image = resize_image(image_data, target_size=(n, m))
+        # L'égalisation quantifie elle-même l'intensité : pas de normalisation séparée
+        enhanced_image = apply_histogram_equalization(resized_image)
+    except Exception as e:
+        raise DicomProcessingError(status_code=500, detail=f"Erreur lors du prétraitement de l'image {filename} : {e}")
+
+    # Sérialiser les sorties en mémoire (aucune écriture sur disque)
+    nib = get_nibabel()
+    processed_nifti = nib.Nifti1Image(enhanced_image, affine)
+
+    return {
+        'original': original,
+        'metadata': conversion_result['metadata'],
+        # .nii brut : la seule compression est celle de l'archive ZIP
+        'nifti': processed_nifti.to_bytes(),
+        # Fichier .hdr (métadonnées DICOM complètes)
+        'hdr': conversion_result['hdr_content'].encode('utf-8')
+    }
+
+
+def _process_dicom_path(file_path: str, filename: str, n: int, m: int) -> dict:
+    """
+    Variante de _process_dicom_file pour un fichier déjà sur disque : lu dans le
+    processus du pool, seul son chemin (et non son contenu) est transmis au worker.
+    """
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    return _process_dicom_file(content, filename, n, m)
+
+
+def _number_result(result: dict, index: int) -> dict:
+    """
+    Attribue au résultat de _process_dicom_file ses identifiants (P/S/SE{index})
+    et renvoie son entrée de nomenclature et ses fichiers de sortie
+    [(nom dans l'archive, octets)].
+    """
+    patient_id = f"P{index:03d}"
+    study_id = f"S{index:03d}"
+    series_id = f"SE{index:03d}"
+
+    metadata = result['metadata']
+    metadata.update(patient_id=patient_id, study_id=study_id, series_id=series_id)
+    output_files = [
+        (f"images/processed_PAT_{index:03d}_ST_{index:03d}_SE_{index:03d}.nii", result['nifti']),
+        (f"metadata/metadata_{patient_id}_{study_id}_{series_id}.json", json.dumps(metadata, indent=4).encode('utf-8')),
+        (f"metadata_hdr/metadata_{patient_id}_{study_id}_{series_id}.hdr", result['hdr']),
+    ]
+
+    nomenclature_entry = {
+        'patient_id_nomenclature': patient_id,
+        'study_id_nomenclature': study_id,
+        'series_id_nomenclature': series_id,
+        **result['original']
+    }
+
+    return {'nomenclature': nomenclature_entry, 'files': output_files}
+
+
+def _write_results_zip(target, results: List[dict]):
+    """Écrit l'archive des résultats (images, métadonnées, nomenclature) dans target (chemin ou fichier)."""
+    with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for result in results:
+            for arcname, data in result['files']:
+                # Images volumineuses : DEFLATE niveau 1 (rapide), texte au niveau par défaut
+                compresslevel = 1 if arcname.endswith('.nii') else None
+                zipf.writestr(arcname, data, compresslevel=compresslevel)
+
+        # Fichier CSV de nomenclature unique (csv standard : pas de DataFrame intermédiaire)
+        csv_buffer = io.StringIO()
+        if results:
+            writer = csv.DictWriter(csv_buffer, fieldnames=list(results[0]['nomenclature'].keys()), lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(result['nomenclature'] for result in results)
+        zipf.writestr("csv_files/nomenclature_mapping.csv", csv_buffer.getvalue())
+
+
 @router.post("/preprocess_dicom_files/")
 async def preprocess_dicom_files(
     files: List[UploadFile] = File(...),
@@ -31,137 +175,30 @@ async def preprocess_dicom_files(
     # Validate uploaded files
     await validate_file_upload(files, allowed_extensions=ALLOWED_DICOM_EXTENSIONS)
 
-    # Créer un répertoire temporaire sécurisé
-    temp_dir = tempfile.mkdtemp()
-    
     try:
-        output_base_dir = os.path.join(temp_dir, "processed_data")
-        os.makedirs(output_base_dir, exist_ok=True)
-
-        nomenclature_entries = []
-        
-        # Initialisation des compteurs
-        patient_counter = 1
-        study_counter = 1
-        series_counter = 1
-
-        for file in files:
-            temp_dicom_path = os.path.join(temp_dir, file.filename)
-            try:
-                with open(temp_dicom_path, "wb") as buffer:
-                    shutil.copyfileobj(file.file, buffer)
-            except Exception:
-                raise HTTPException(status_code=500, detail=f"Erreur lors de la sauvegarde du fichier : {file.filename}.")
-
-            try:
-                pydicom = get_pydicom()
-                dicom_data = pydicom.dcmread(temp_dicom_path)
-            except Exception:
-                os.remove(temp_dicom_path)
-                raise HTTPException(status_code=400, detail=f"Le fichier {file.filename} n'est pas un fichier DICOM valide.")
-
-            # Extraire les métadonnées originales
-            original_patient_id = str(dicom_data.get('PatientID', ''))
-            original_study_id = str(dicom_data.get('StudyID', ''))
-            original_modality = str(dicom_data.get('Modality', ''))
-            original_study_date = str(dicom_data.get('StudyDate', ''))
-            original_study_desc = str(dicom_data.get('StudyDescription', ''))
-            original_study_time = str(dicom_data.get('StudyTime', ''))
-
-            # Anonymiser les données
-            anonymized_dicom = anonymize_dicom(dicom_data)
-            
-            # Convertir en NIfTI et prétraiter
-            conversion_result = convert_dicom_to_nifti(
-                anonymized_dicom,
-                f"P{patient_counter:03d}",
-                f"S{study_counter:03d}",
-                f"SE{series_counter:03d}"
-            )
-
-            if not conversion_result:
-                raise HTTPException(status_code=500, detail=f"Erreur lors de la conversion ou du prétraitement pour le fichier {file.filename}.")
-
-            image_data = conversion_result['pixel_array']
-            nifti_img = conversion_result['nifti_img']
-            metadata = conversion_result['metadata']
-
-            # Appliquer le prétraitement
-            try:
-                resized_image = resize_image(image_data, target_size=(n, m))
-                normalized_image = normalize_image(resized_image)
-                enhanced_image = apply_histogram_equalization(normalized_image)
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=f"Erreur lors du prétraitement de l'image {file.filename} : {e}")
-
-            # Sauvegarder l'image prétraitée
-            nib = get_nibabel()
-            processed_nifti = nib.Nifti1Image(enhanced_image, nifti_img.affine)
-            images_dir = os.path.join(output_base_dir, "images")
-            os.makedirs(images_dir, exist_ok=True)
-            processed_filename = f"processed_PAT_{patient_counter:03d}_ST_{study_counter:03d}_SE_{series_counter:03d}.nii.gz"
-            processed_filepath = os.path.join(images_dir, processed_filename)
-            nib.save(processed_nifti, processed_filepath)
-
-            # Sauvegarder les métadonnées
-            metadata_dir = os.path.join(output_base_dir, "metadata")
-            os.makedirs(metadata_dir, exist_ok=True)
-            metadata_filename = f"metadata_P{patient_counter:03d}_S{study_counter:03d}_SE{series_counter:03d}.json"
-            metadata_filepath = os.path.join(metadata_dir, metadata_filename)
-            with open(metadata_filepath, 'w') as f:
-                json.dump(metadata, f, indent=4)
-
-            # Sauvegarder le fichier .hdr (métadonnées DICOM complètes)
-            hdr_dir = os.path.join(output_base_dir, "metadata_hdr")
-            os.makedirs(hdr_dir, exist_ok=True)
-            hdr_filename = f"metadata_P{patient_counter:03d}_S{study_counter:03d}_SE{series_counter:03d}.hdr"
-            hdr_filepath = os.path.join(hdr_dir, hdr_filename)
-            with open(hdr_filepath, 'w', encoding='utf-8') as f:
-                f.write(conversion_result['hdr_content'])
-
-            # Ajouter l'entrée de nomenclature
-            nomenclature_entry = {
-                'patient_id_nomenclature': f"P{patient_counter:03d}",
-                'study_id_nomenclature': f"S{study_counter:03d}",
-                'series_id_nomenclature': f"SE{series_counter:03d}",
-                'original_patient_id': original_patient_id,
-                'original_study_id': original_study_id,
-                'original_modality': original_modality,
-                'original_study_date': original_study_date,
-                'Study_Description': original_study_desc,
-                'Study_Time': original_study_time
-            }
-            nomenclature_entries.append(nomenclature_entry)
-
-            # Incrémenter les compteurs pour le prochain fichier
-            patient_counter += 1
-            study_counter += 1
-            series_counter += 1
-
-        # Créer le fichier CSV de nomenclature unique
-        csv_dir = os.path.join(output_base_dir, "csv_files")
-        os.makedirs(csv_dir, exist_ok=True)
-        df = pd.DataFrame(nomenclature_entries)
-        csv_filename = os.path.join(csv_dir, "nomenclature_mapping.csv")
-        df.to_csv(csv_filename, index=False)
-
-        # Créer l'archive ZIP
-        zip_path = os.path.join(temp_dir, "processed_medical_images")
-        shutil.make_archive(zip_path, 'zip', output_base_dir)
-
-        # Préparer le fichier zip pour le streaming
-        zip_file_path = f"{zip_path}.zip"
-
-        # Lire le fichier zip en mémoire pour le renvoyer
-        zip_buffer = io.BytesIO()
-        with open(zip_file_path, "rb") as f:
-            zip_buffer.write(f.read())
+        # Lire les fichiers, puis les traiter en parallèle dans le pool de processus :
+        # décodage pydicom, noyaux Numba et sérialisation NIfTI tiennent le GIL
+        contents = await asyncio.gather(*[file.read() for file in files])
+        loop = asyncio.get_running_loop()
+        pool = get_process_pool()
+        try:
+            results = await asyncio.gather(*[
+                loop.run_in_executor(pool, _process_dicom_file, content, file.filename, n, m)
+                for file, content in zip(files, contents)
+            ])
+        except DicomProcessingError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        results = [_number_result(result, index) for index, result in enumerate(results, start=1)]
+
+        # Créer l'archive ZIP en une passe : en mémoire, puis sur disque au-delà du seuil
+        zip_buffer = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE)
+        _write_results_zip(zip_buffer, results)
         zip_buffer.seek(0)
 
         return StreamingResponse(
-            zip_buffer,
+            _iter_file_chunks(zip_buffer),
             media_type="application/zip",
-            headers={"Content-Disposition": f"attachment; filename={os.path.basename(zip_file_path)}"}
+            headers={"Content-Disposition": "attachment; filename=processed_medical_images.zip"}
         )
     
     except HTTPException:
@@ -172,13 +209,6 @@ async def preprocess_dicom_files(
             status_code=500,
             detail="Erreur lors du prétraitement des fichiers DICOM."
         )
-    finally:
-        # Always cleanup temp directory
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                shutil.rmtree(temp_dir)
-            except Exception as cleanup_error:
-                logger.error(f"Failed to cleanup temp directory: {cleanup_error}")
 
 
 @router.post("/preprocess_dicom_files_async/")
@@ -209,9 +239,10 @@ async def preprocess_dicom_files_async(
     try:
         for file in files:
             file_path = os.path.join(temp_upload_dir, file.filename)
+            # Copie par blocs de 1 Mo : le fichier n'est jamais entièrement en mémoire
             with open(file_path, "wb") as f:
-                content = await file.read()
-                f.write(content)
+                while chunk := await file.read(STREAM_CHUNK_SIZE):
+                    f.write(chunk)
             saved_files.append((file.filename, file_path))
     except Exception as e:
         shutil.rmtree(temp_upload_dir, ignore_errors=True)
@@ -246,126 +277,47 @@ def _process_dicom_background(job_id: str, files: List[tuple], temp_upload_dir:
         job_tracker.update_status(job_id, JobStatus.PROCESSING, progress=5, message="Initialisation...")
         
         temp_dir = tempfile.mkdtemp()
-        output_base_dir = os.path.join(temp_dir, "processed_data")
-        os.makedirs(output_base_dir, exist_ok=True)
-        
-        nomenclature_entries = []
-        patient_counter = 1
-        study_counter = 1
-        series_counter = 1
-        
         total_files = len(files)
         
-        for idx, (filename, file_path) in enumerate(files):
+        # Process the files in parallel in the shared process pool, as the synchronous endpoint does
+        pool = get_process_pool()
+        futures = {
+            pool.submit(_process_dicom_path, file_path, filename, n, m): filename
+            for filename, file_path in files
+        }
+        
+        processed = {}
+        for done, future in enumerate(as_completed(futures), start=1):
             # Update progress
-            progress = 10 + int((idx / total_files) * 70)
+            progress = 10 + int((done / total_files) * 70)
             job_tracker.update_status(
                 job_id, 
                 JobStatus.PROCESSING, 
                 progress=progress,
-                message=f"Traitement du fichier {idx + 1}/{total_files}: {filename}"
+                message=f"Traitement des fichiers : {done}/{total_files} terminés"
             )
             
+            # Invalid files and files failing during processing are skipped
             try:
-                pydicom = get_pydicom()
-                dicom_data = pydicom.dcmread(file_path)
-            except Exception:
-                logger.warning(f"Skipping invalid DICOM file: {filename}")
-                continue
-            
-            # Extract metadata
-            original_patient_id = str(dicom_data.get('PatientID', ''))
-            original_study_id = str(dicom_data.get('StudyID', ''))
-            original_modality = str(dicom_data.get('Modality', ''))
-            original_study_date = str(dicom_data.get('StudyDate', ''))
-            original_study_desc = str(dicom_data.get('StudyDescription', ''))
-            original_study_time = str(dicom_data.get('StudyTime', ''))
-            
-            # Anonymize
-            anonymized_dicom = anonymize_dicom(dicom_data)
-            
-            # Convert to NIfTI
-            conversion_result = convert_dicom_to_nifti(
-                anonymized_dicom,
-                f"P{patient_counter:03d}",
-                f"S{study_counter:03d}",
-                f"SE{series_counter:03d}"
-            )
-            
-            if not conversion_result:
-                continue
-            
-            image_data = conversion_result['pixel_array']
-            nifti_img = conversion_result['nifti_img']
-            metadata = conversion_result['metadata']
-            
-            # Preprocess
-            resized_image = resize_image(image_data, target_size=(n, m))
-            normalized_image = normalize_image(resized_image)
-            enhanced_image = apply_histogram_equalization(normalized_image)
-            
-            # Save processed image
-            nib = get_nibabel()
-            processed_nifti = nib.Nifti1Image(enhanced_image, nifti_img.affine)
-            images_dir = os.path.join(output_base_dir, "images")
-            os.makedirs(images_dir, exist_ok=True)
-            processed_filename = f"processed_PAT_{patient_counter:03d}_ST_{study_counter:03d}_SE_{series_counter:03d}.nii.gz"
-            processed_filepath = os.path.join(images_dir, processed_filename)
-            nib.save(processed_nifti, processed_filepath)
-            
-            # Save metadata
-            metadata_dir = os.path.join(output_base_dir, "metadata")
-            os.makedirs(metadata_dir, exist_ok=True)
-            metadata_filename = f"metadata_P{patient_counter:03d}_S{study_counter:03d}_SE{series_counter:03d}.json"
-            metadata_filepath = os.path.join(metadata_dir, metadata_filename)
-            with open(metadata_filepath, 'w') as f:
-                json.dump(metadata, f, indent=4)
-            
-            # Save HDR file
-            hdr_dir = os.path.join(output_base_dir, "metadata_hdr")
-            os.makedirs(hdr_dir, exist_ok=True)
-            hdr_filename = f"metadata_P{patient_counter:03d}_S{study_counter:03d}_SE{series_counter:03d}.hdr"
-            hdr_filepath = os.path.join(hdr_dir, hdr_filename)
-            with open(hdr_filepath, 'w', encoding='utf-8') as f:
-                f.write(conversion_result['hdr_content'])
-            
-            # Add nomenclature entry
-            nomenclature_entry = {
-                'patient_id_nomenclature': f"P{patient_counter:03d}",
-                'study_id_nomenclature': f"S{study_counter:03d}",
-                'series_id_nomenclature': f"SE{series_counter:03d}",
-                'original_patient_id': original_patient_id,
-                'original_study_id': original_study_id,
-                'original_modality': original_modality,
-                'original_study_date': original_study_date,
-                'Study_Description': original_study_desc,
-                'Study_Time': original_study_time
-            }
-            nomenclature_entries.append(nomenclature_entry)
-            
-            patient_counter += 1
-            study_counter += 1
-            series_counter += 1
+                processed[future] = future.result()
+            except DicomProcessingError as e:
+                logger.warning(f"Skipping DICOM file {futures[future]}: {e.detail}")
         
-        # Create nomenclature CSV
-        job_tracker.update_status(job_id, JobStatus.PROCESSING, progress=85, message="Création du fichier de nomenclature...")
-        csv_dir = os.path.join(output_base_dir, "csv_files")
-        os.makedirs(csv_dir, exist_ok=True)
-        pd = get_pandas()
-        df = pd.DataFrame(nomenclature_entries)
-        csv_filename = os.path.join(csv_dir, "nomenclature_mapping.csv")
-        df.to_csv(csv_filename, index=False)
+        # IDs are assigned in upload order over the files actually processed, so they stay contiguous
+        results = [
+            _number_result(result, index)
+            for index, result in enumerate((processed[future] for future in futures if future in processed), start=1)
+        ]
         
         # Create ZIP archive
-        job_tracker.update_status(job_id, JobStatus.PROCESSING, progress=95, message="Création de l'archive ZIP...")
-        zip_path = os.path.join(temp_dir, "processed_medical_images")
-        shutil.make_archive(zip_path, 'zip', output_base_dir)
-        zip_file_path = f"{zip_path}.zip"
+        job_tracker.update_status(job_id, JobStatus.PROCESSING, progress=90, message="Création de l'archive ZIP...")
+        zip_file_path = os.path.join(temp_dir, "processed_medical_images.zip")
+        _write_results_zip(zip_file_path, results)
         
         # Store result path (in production, upload to S3/cloud storage)
         job_tracker.set_result(job_id, {
             "zip_path": zip_file_path,
-            "files_processed": len(nomenclature_entries),
+            "files_processed": len(results),
             "temp_dir": temp_dir
         })
         
@@ -421,7 +373,7 @@ async def convert_dicom_for_viewer(file: UploadFile = File(...)):
         # Read DICOM file
         content = await file.read()
         pydicom = get_pydicom()
-        dicom_dataset = pydicom.dcmread(io.BytesIO(content))
+        dicom_dataset = pydicom.dcmread(io.BytesIO(content), defer_size=DICOM_DEFER_SIZE)
 
         # Extract pixel data
         pixel_array = dicom_dataset.pixel_array
@@ -3,6 +3,7 @@ from fastapi.responses import JSONResponse, StreamingResponse
 from collections import Counter
 import os
 import re
+import asyncio
 from typing import Dict, List, Optional, Union
 from datetime import datetime
 import json
@@ -36,6 +37,148 @@ class BatchProcessingResult(BaseModel):
     fichiers_echecs: List[Dict[str, str]]
     donnees_combinees: List[Dict]
 
+def _records(df) -> List[Dict]:
+    """Lignes du DataFrame en dictionnaires, cellules manquantes (NaN) converties en None pour le JSON"""
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+# Traitements synchrones par fichier, exécutés dans des threads (asyncio.to_thread)
+# pour ne pas bloquer la boucle d'événements
+
+def _lire_lignes(content: bytes, filename: str) -> Optional[List[str]]:
+    """Lignes non vides d'un rapport .docx ou .txt, None pour un autre format"""
+    if filename.endswith('.docx'):
+        return extract_text_from_docx(content)
+    if filename.endswith('.txt'):
+        text_content = content.decode('utf-8')
+        return [line.strip() for line in text_content.split('\n') if line.strip()]
+    return None
+
+def _lire_dataframe(content: bytes, filename: str):
+    """DataFrame d'un rapport (.docx/.txt) ou d'un tableau (.xlsx/.xls/.csv/.json), None si format non supporté"""
+    pd = get_pandas()
+    filename = filename.lower()
+    if filename.endswith(('.docx', '.txt')):
+        return pd.DataFrame([parse_report(_lire_lignes(content, filename))])
+    elif filename.endswith(('.xlsx', '.xls')):
+        return pd.read_excel(io.BytesIO(content))
+    elif filename.endswith('.csv'):
+        return read_csv_bytes(content)
+    elif filename.endswith('.json'):
+        return pd.read_json(io.BytesIO(content))
+    return None
+
+def _analyser_document(content: bytes, filename: str) -> Dict:
+    """Analyse un document et renvoie son entrée de résultat"""
+    try:
+        lignes = _lire_lignes(content, filename.lower())
+        if lignes is None:
+            return {
+                "filename": filename,
+                "status": "error",
+                "error": "Format non supporté. Utilisez .docx ou .txt"
+            }
+        donnees = parse_report(lignes)
+        donnees["Fichier_source"] = filename
+        return {
+            "filename": filename,
+            "status": "success",
+            "donnees_extraites": donnees
+        }
+    except Exception as e:
+        return {
+            "filename": filename,
+            "status": "error",
+            "error": str(e)
+        }
+
+def _lire_fichier_a_annoter(content: bytes, filename: str) -> tuple:
+    """Lit un fichier à annoter ; renvoie (None, DataFrame) ou (entrée d'erreur, None)"""
+    try:
+        df = _lire_dataframe(content, filename)
+        if df is None:
+            return {
+                "filename": filename,
+                "status": "error",
+                "error": "Format non supporté"
+            }, None
+        
+        # Ajouter le nom du fichier source
+        df['Fichier_source'] = filename
+        return None, df
+    except Exception as e:
+        return {
+            "filename": filename,
+            "status": "error",
+            "error": str(e)
+        }, None
+
+def _resultat_fichier(filename: str, df, df1_fichier, df2_fichier) -> Dict:
+    """Entrée de résultat d'un fichier à partir de ses lignes annotées"""
+    return {
+        "filename": filename,
+        "status": "success",
+        "df_personnel": _records(df1_fichier) if df1_fichier is not None else [],
+        "df_medical": _records(df2_fichier) if df2_fichier is not None else [],
+        "nombre_enregistrements": len(df)
+    }
+
+def _combiner_et_annoter(dfs: List):
+    """Concatène les DataFrames et génère les annotations de l'ensemble"""
+    pd = get_pandas()
+    df_combined = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+    return Annotation(df_combined)
+
+async def _lire_et_annoter(files: List[UploadFile]) -> tuple:
+    """
+    Chemin commun de /generer_annotations et /telecharger_annotations_zip : lit les fichiers
+    en parallèle dans des threads, puis annote l'ensemble en une seule passe.
+    Renvoie (lus, df1_combined, df2_combined), lus étant les paires (entrée d'erreur, DataFrame) par fichier.
+    """
+    contents = await asyncio.gather(*[file.read() for file in files])
+    lus = await asyncio.gather(*[
+        asyncio.to_thread(_lire_fichier_a_annoter, content, file.filename)
+        for file, content in zip(files, contents)
+    ])
+    all_dfs = [df for _, df in lus if df is not None]
+    df1_combined, df2_combined = await asyncio.to_thread(_combiner_et_annoter, all_dfs)
+    return lus, df1_combined, df2_combined
+
+def _supprimer_colonnes_fichier(content: bytes, filename: str, colonnes_a_supprimer: List[str]) -> Optional[tuple]:
+    """Supprime les colonnes d'un tableau ; renvoie (nom dans l'archive, octets, compress_type) ou None si ignoré"""
+    try:
+        pd = get_pandas()
+        lower_name = filename.lower()
+        if lower_name.endswith(('.xlsx', '.xls')):
+            df = pd.read_excel(io.BytesIO(content))
+        elif lower_name.endswith('.csv'):
+            df = read_csv_bytes(content)
+        elif lower_name.endswith('.json'):
+            df = pd.read_json(io.BytesIO(content))
+        else:
+            return None  # Ignorer les formats non supportés
+        
+        # Supprimer les colonnes spécifiées
+        protected_column = 'ID d\'annotation'
+        cols_to_drop_filtered = [col for col in colonnes_a_supprimer if col != protected_column]
+        existing_cols_to_drop = [col for col in cols_to_drop_filtered if col in df.columns]
+        
+        if existing_cols_to_drop:
+            df_modified = df.drop(columns=existing_cols_to_drop)
+        else:
+            df_modified = df
+        
+        base_name = Path(filename).stem
+        extension = Path(filename).suffix
+        
+        if extension in ['.xlsx', '.xls']:
+            return f"{base_name}_modifie{extension}", dataframe_to_xlsx(df_modified), zipfile.ZIP_STORED
+        else:
+            with io.StringIO() as buffer:
+                df_modified.to_csv(buffer, index=False)
+                return f"{base_name}_modifie.csv", buffer.getvalue().encode('utf-8'), None
+    except Exception:
+        return None  # Ignorer les fichiers avec erreurs
+
 # Endpoints de l'API
 @router.get("/")
 async def root():
@@ -60,42 +203,12 @@ async def analyser_documents(files: List[UploadFile] = File(...)):
     await validate_file_upload(files, allowed_extensions=ALLOWED_TEXT_EXTENSIONS)
 
     try:
-        all_data = []
-        results = []
-        
-        for file in files:
-            try:
-                content = await file.read()
-                
-                if file.filename.lower().endswith('.docx'):
-                    lignes = extract_text_from_docx(content)
-                elif file.filename.lower().endswith('.txt'):
-                    text_content = content.decode('utf-8')
-                    lignes = [line.strip() for line in text_content.split('\n') if line.strip()]
-                else:
-                    results.append({
-                        "filename": file.filename,
-                        "status": "error",
-                        "error": "Format non supporté. Utilisez .docx ou .txt"
-                    })
-                    continue
-                
-                donnees = parse_report(lignes)
-                donnees["Fichier_source"] = file.filename
-                all_data.append(donnees)
-                
-                results.append({
-                    "filename": file.filename,
-                    "status": "success",
-                    "donnees_extraites": donnees
-                })
-                
-            except Exception as e:
-                results.append({
-                    "filename": file.filename,
-                    "status": "error",
-                    "error": str(e)
-                })
+        contents = await asyncio.gather(*[file.read() for file in files])
+        results = await asyncio.gather(*[
+            asyncio.to_thread(_analyser_document, content, file.filename)
+            for file, content in zip(files, contents)
+        ])
+        all_data = [result["donnees_extraites"] for result in results if result["status"] == "success"]
         
         pd = get_pandas()
         df_combined = pd.DataFrame(all_data) if all_data else pd.DataFrame()
@@ -103,7 +216,7 @@ async def analyser_documents(files: List[UploadFile] = File(...)):
         return {
             "nombre_fichiers": len(files),
             "resultats": results,
-            "donnees_combinees": df_combined.to_dict('records')
+            "donnees_combinees": _records(df_combined)
         }
         
     except HTTPException:
@@ -124,70 +237,34 @@ async def generer_annotations(files: List[UploadFile] = File(...)):
     await validate_file_upload(files, allowed_extensions=ALLOWED_TEXT_EXTENSIONS)
 
     try:
-        all_dfs = []
-        results = []
+        # Combiner tous les DataFrames et les annoter en une seule passe
+        lus, df1_combined, df2_combined = await _lire_et_annoter(files)
         
-        for file in files:
-            try:
-                content = await file.read()
-                filename = file.filename.lower()
-                
-                # Lire le fichier selon son type
-                if filename.endswith('.docx'):
-                    lignes = extract_text_from_docx(content)
-                    donnees = parse_report(lignes)
-                    df = pd.DataFrame([donnees])
-                elif filename.endswith('.txt'):
-                    text_content = content.decode('utf-8')
-                    lignes = [line.strip() for line in text_content.split('\n') if line.strip()]
-                    donnees = parse_report(lignes)
-                    df = pd.DataFrame([donnees])
-                elif filename.endswith(('.xlsx', '.xls')):
-                    df = pd.read_excel(io.BytesIO(content))
-                elif filename.endswith('.csv'):
-                    df = pd.read_csv(io.BytesIO(content))
-                elif filename.endswith('.json'):
-                    df = pd.read_json(io.BytesIO(content))
-                else:
-                    results.append({
-                        "filename": file.filename,
-                        "status": "error",
-                        "error": "Format non supporté"
-                    })
-                    continue
-                
-                # Ajouter le nom du fichier source
-                df['Fichier_source'] = file.filename
-                all_dfs.append(df)
-                
-                # Générer les annotations
-                df1, df2 = Annotation(df)
-                
-                results.append({
-                    "filename": file.filename,
-                    "status": "success",
-                    "df_personnel": df1.to_dict('records') if df1 is not None else [],
-                    "df_medical": df2.to_dict('records') if df2 is not None else [],
-                    "nombre_enregistrements": len(df)
-                })
-                
-            except Exception as e:
-                results.append({
-                    "filename": file.filename,
-                    "status": "error",
-                    "error": str(e)
+        # Résultats par fichier : ses lignes sont contiguës dans l'ensemble, dans l'ordre des fichiers.
+        # Ils sont construits sur son propre DataFrame (types d'origine, non élargis par la
+        # concaténation), complété des colonnes calculées sur l'ensemble
+        results = []
+        start = 0
+        for file, (erreur, df) in zip(files, lus):
+            if df is None:
+                results.append(erreur)
+                continue
+            stop = start + len(df)
+            df1_fichier = df2_fichier = None
+            if df1_combined is not None:
+                df_annote = df.assign(**{
+                    'ID d\'annotation': df1_combined['ID d\'annotation'].iloc[start:stop].to_numpy(),
+                    'Année de naissance': df1_combined['Année de naissance'].iloc[start:stop].to_numpy()
                 })
-        
-        # Combiner tous les DataFrames
-        pd = get_pandas()
-        df_combined = pd.concat(all_dfs, ignore_index=True) if all_dfs else pd.DataFrame()
-        df1_combined, df2_combined = Annotation(df_combined)
+                df1_fichier, df2_fichier = diviser_annotations(df_annote)
+            results.append(_resultat_fichier(file.filename, df, df1_fichier, df2_fichier))
+            start = stop
         
         return {
             "nombre_fichiers": len(files),
             "resultats": results,
-            "df_personnel_combine": df1_combined.to_dict('records') if df1_combined is not None else [],
-            "df_medical_combine": df2_combined.to_dict('records') if df2_combined is not None else []
+            "df_personnel_combine": _records(df1_combined) if df1_combined is not None else [],
+            "df_medical_combine": _records(df2_combined) if df2_combined is not None else []
         }
         
     except HTTPException:
@@ -199,8 +276,21 @@ async def generer_annotations(files: List[UploadFile] = File(...)):
             detail="Erreur lors de la génération d'annotations."
         )
 
+def _flux_zip(premier_bloc: bytes, blocs):
+    """
+    Réémet le premier bloc du ZIP, déjà écrit, puis la suite au fil de l'écriture.
+    Une fois l'envoi commencé, une erreur ne peut plus devenir une réponse 500 :
+    elle est journalisée ici avant d'interrompre le transfert.
+    """
+    yield premier_bloc
+    try:
+        yield from blocs
+    except Exception as e:
+        logger.error(f"Error streaming ZIP: {e}", exc_info=True)
+        raise
+
 @router.post("/telecharger_annotations_zip")
-async def telecharger_annotations_zip(background_tasks: BackgroundTasks, files: List[UploadFile] = File(...)):
+async def telecharger_annotations_zip(files: List[UploadFile] = File(...)):
     """
     Génère des annotations pour plusieurs fichiers et retourne un ZIP avec les résultats
     """
@@ -208,53 +298,18 @@ async def telecharger_annotations_zip(background_tasks: BackgroundTasks, files:
     await validate_file_upload(files, allowed_extensions=ALLOWED_TEXT_EXTENSIONS)
 
     try:
-        all_dfs = []
+        # Combiner tous les DataFrames et générer les annotations ; les fichiers illisibles sont ignorés
+        lus, df1_combined, df2_combined = await _lire_et_annoter(files)
         
-        for file in files:
-            try:
-                content = await file.read()
-                filename = file.filename.lower()
-                
-                # Lire le fichier selon son type
-                pd = get_pandas()
-                if filename.endswith('.docx'):
-                    lignes = extract_text_from_docx(content)
-                    donnees = parse_report(lignes)
-                    df = pd.DataFrame([donnees])
-                elif filename.endswith('.txt'):
-                    text_content = content.decode('utf-8')
-                    lignes = [line.strip() for line in text_content.split('\n') if line.strip()]
-                    donnees = parse_report(lignes)
-                    df = pd.DataFrame([donnees])
-                elif filename.endswith(('.xlsx', '.xls')):
-                    df = pd.read_excel(io.BytesIO(content))
-                elif filename.endswith('.csv'):
-                    df = pd.read_csv(io.BytesIO(content))
-                elif filename.endswith('.json'):
-                    df = pd.read_json(io.BytesIO(content))
-                else:
-                    continue  # Ignorer les formats non supportés
-                
-                # Ajouter le nom du fichier source
-                df['Fichier_source'] = file.filename
-                all_dfs.append(df)
-                
-            except Exception:
-                continue  # Ignorer les fichiers avec erreurs
-        
-        if not all_dfs:
+        if all(df is None for _, df in lus):
             raise HTTPException(status_code=400, detail="Aucun fichier valide à traiter")
         
-        # Combiner tous les DataFrames et générer les annotations
-        pd = get_pandas()
-        df_combined = pd.concat(all_dfs, ignore_index=True)
-        df1_combined, df2_combined = Annotation(df_combined)
-        
-        # Créer le ZIP
-        zip_content = creer_zip_resultats(df1_combined, df2_combined)
-        
+        # Créer le ZIP, envoyé au fil de l'écriture de chaque membre. Le premier membre est
+        # écrit avant l'envoi : une erreur à ce stade donne encore une réponse 500
+        blocs = creer_zip_resultats(df1_combined, df2_combined)
+        premier_bloc = await asyncio.to_thread(next, blocs, b'')
         return StreamingResponse(
-            io.BytesIO(zip_content),
+            _flux_zip(premier_bloc, blocs),
             media_type="application/zip",
             headers={"Content-Disposition": "attachment; filename=annotations_medicales.zip"}
         )
@@ -270,7 +325,6 @@ async def telecharger_annotations_zip(background_tasks: BackgroundTasks, files:
 
 @router.post("/supprimer_colonnes_zip")
 async def supprimer_colonnes_zip(
-    background_tasks: BackgroundTasks,
     colonnes_a_supprimer: List[str] = Form(...),
     files: List[UploadFile] = File(...)
 ):
@@ -280,69 +334,26 @@ async def supprimer_colonnes_zip(
     # Validate uploaded files
     await validate_file_upload(files, allowed_extensions=ALLOWED_TEXT_EXTENSIONS)
 
-    # Créer un répertoire temporaire
-    temp_dir = tempfile.mkdtemp()
-    
     try:
-        zip_path = os.path.join(temp_dir, "fichiers_modifies.zip")
+        contents = await asyncio.gather(*[file.read() for file in files])
+        members = await asyncio.gather(*[
+            asyncio.to_thread(_supprimer_colonnes_fichier, content, file.filename, colonnes_a_supprimer)
+            for file, content in zip(files, contents)
+        ])
         
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for file in files:
-                try:
-                    content = await file.read()
-                    filename = file.filename.lower()
-                    
-                    # Lire le fichier
-                    pd = get_pandas()
-                    if filename.endswith(('.xlsx', '.xls')):
-                        df = pd.read_excel(io.BytesIO(content))
-                    elif filename.endswith('.csv'):
-                        df = pd.read_csv(io.BytesIO(content))
-                    elif filename.endswith('.json'):
-                        df = pd.read_json(io.BytesIO(content))
-                    else:
-                        continue  # Ignorer les formats non supportés
-                    
-                    # Supprimer les colonnes spécifiées
-                    protected_column = 'ID d\'annotation'
-                    cols_to_drop_filtered = [col for col in colonnes_a_supprimer if col != protected_column]
-                    existing_cols_to_drop = [col for col in cols_to_drop_filtered if col in df.columns]
-                    
-                    if existing_cols_to_drop:
-                        df_modified = df.drop(columns=existing_cols_to_drop)
-                    else:
-                        df_modified = df
-                    
-                    # Ajouter le fichier modifié au ZIP
-                    base_name = Path(file.filename).stem
-                    extension = Path(file.filename).suffix
-                    
-                    if extension in ['.xlsx', '.xls']:
-                        with io.BytesIO() as buffer:
-                            pd = get_pandas()
-                            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                                df_modified.to_excel(writer, index=False)
-                            zipf.writestr(f"{base_name}_modifie{extension}", buffer.getvalue())
-                    else:
-                        with io.StringIO() as buffer:
-                            df_modified.to_csv(buffer, index=False)
-                            zipf.writestr(f"{base_name}_modifie.csv", buffer.getvalue().encode('utf-8'))
-                            
-                except Exception:
-                    continue  # Ignorer les fichiers avec erreurs
+        # ZIP construit directement en mémoire, sans passer par le disque.
+        # Même politique que creer_zip_resultats : CSV compressé au niveau 1, .xlsx stocké
+        def write_zip():
+            zip_buffer = io.BytesIO()
+            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zipf:
+                for member in members:
+                    if member is not None:
+                        arcname, data, compress_type = member
+                        zipf.writestr(arcname, data, compress_type=compress_type)
+            zip_buffer.seek(0)
+            return zip_buffer
         
-        # Read ZIP into memory to avoid file handle leak
-        zip_buffer = io.BytesIO()
-        with open(zip_path, "rb") as f:
-            zip_buffer.write(f.read())
-        zip_buffer.seek(0)
-
-        # Nettoyer les fichiers temporaires après envoi
-        def remove_temp_files():
-            import shutil
-            shutil.rmtree(temp_dir, ignore_errors=True)
-
-        background_tasks.add_task(remove_temp_files)
+        zip_buffer = await asyncio.to_thread(write_zip)
 
         return StreamingResponse(
             zip_buffer,
@@ -358,13 +369,6 @@ async def supprimer_colonnes_zip(
             status_code=500,
             detail="Erreur lors de la suppression des colonnes."
         )
-    finally:
-        # Always cleanup temp directory
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                shutil.rmtree(temp_dir)
-            except Exception as cleanup_error:
-                logger.error(f"Failed to cleanup temp directory: {cleanup_error}")
 
 @router.get("/sante")
 async def verifier_sante():